@@ -0,0 +1,297 @@
+from __future__ import annotations
+from typing import Union, Callable
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import calutils
+import extpandas
+import parallelmap
+from retutils import RetCalc
+
+
+def synthetic_panel(n_symbols: int = 500,
+                    n_days: int = 1000,
+                    calendar: str = 'SSE',
+                    start: str = '2010-01-01',
+                    suspension_rate: float = 0.002,
+                    mean_suspension: float = 5.0,
+                    listing_spread: float = 0.2,
+                    nan_rate: float = 0.001,
+                    seed: int = 0) -> pd.DataFrame:
+    """
+    Seeded synthetic symbol x date return panel on the trading days of a bundled calendar,
+    sorted by symbol and date as the returns data of RetCalc
+
+    :param n_symbols: number of symbols
+    :param n_days: number of consecutive trading days from start
+    :param calendar: exchange name or calendar csv file, see calutils.get_calendar
+    :param suspension_rate: probability that a suspension starts on a trading day
+    :param mean_suspension: mean length in trading days of a suspension (geometric distribution)
+    :param listing_spread: symbols are listed on a uniformly random day in the first listing_spread of the days
+    :param nan_rate: probability that a traded day has a missing return
+    :param seed: seed of the random generator, the same arguments always produce the same panel
+    """
+    days = calutils.get_calendar(calendar).dates
+    days = days[days >= np.datetime64(start, 'D')][:n_days]
+    if len(days) < n_days:
+        raise ValueError(f'calendar {calendar!r} has only {len(days)} trading days from {start}')
+    rng = np.random.default_rng(seed)
+
+    ## suspensions start at random days and last for geometric numbers of days, marked by a difference array
+    ## 停牌在随机交易日开始，持续天数服从几何分布，用差分数组标记
+    starts = np.argwhere(rng.random((n_symbols, n_days)) < suspension_rate)
+    lengths = rng.geometric(1 / mean_suspension, size=len(starts))
+    marks = np.zeros((n_symbols, n_days + 1), dtype=np.int64)
+    np.add.at(marks, (starts[:, 0], starts[:, 1]), 1)
+    np.add.at(marks, (starts[:, 0], np.minimum(starts[:, 1] + lengths, n_days)), -1)
+    traded = np.cumsum(marks[:, :-1], axis=1) == 0
+
+    ## symbols are listed at different days
+    ## 股票在不同日期上市
+    listing = rng.integers(0, max(int(n_days * listing_spread), 1), size=n_symbols)
+    traded &= np.arange(n_days) >= listing[:, None]
+
+    ## fat-tailed returns with a different volatility for each symbol
+    ## 厚尾分布的收益率，每只股票波动率不同
+    symbol, day = np.nonzero(traded)
+    vol = rng.lognormal(np.log(0.02), 0.3, size=n_symbols)
+    rets = rng.standard_t(4, size=len(symbol)) * vol[symbol] / np.sqrt(2)
+    rets[rng.random(len(rets)) < nan_rate] = np.nan
+    panel = pd.DataFrame({'symbol': np.char.add('S', np.char.zfill(symbol.astype(str), 6)),
+                          'date': days[day].astype('datetime64[ns]'),
+                          'ret': np.maximum(rets, -0.99)})
+    panel.attrs['calendar'] = calendar
+    return panel
+
+
+## benchmark workloads, defined at module level so that they can be sent to worker processes
+## 基准测试任务，定义在模块层级以便发送到子进程
+def _demean(group: pd.DataFrame):
+    return group['ret'] - group['ret'].mean()
+
+
+def _window_mean(window):
+    return window.mean()
+
+
+def _task(values: np.ndarray):
+    return float(np.sort(values).cumsum().sum())
+
+
+def _case_ret_pM_pN(panel, workers):
+    RetCalc(panel, calendar_path=panel.attrs.get('calendar', 'SSE')).ret_pM_pN_batch([(1, 1), (1, 5), (2, 5), (1, 20)])
+
+
+def _case_ret_m_K(panel, workers):
+    RetCalc(panel, calendar_path=panel.attrs.get('calendar', 'SSE')).ret_m_K_batch([1, 15])
+
+
+def _case_groupby_pickle(panel, workers):
+    extpandas.parallel_groupby_apply(panel.groupby('symbol'), _demean, max_workers=workers, progress_bar=False)
+
+
+def _case_groupby_shared(panel, workers):
+    extpandas.parallel_groupby_apply(panel.groupby('symbol'), _demean, transport='shared',
+                                     max_workers=workers, progress_bar=False)
+
+
+def _case_rolling_blocks(panel, workers):
+    extpandas.parallel_rolling_apply(panel['ret'].rolling(20), _window_mean, blocks='auto',
+                                     max_workers=workers, progress_bar=False)
+
+
+def _map_tasks(panel):
+    return [group.to_numpy() for _, group in panel.groupby('symbol')['ret']]
+
+
+def _case_map_loky(panel, workers):
+    parallelmap.map_loky(_task, _map_tasks(panel), max_workers=workers, progress_bar=False, chunksize='auto')
+
+
+def _case_imap_loky(panel, workers):
+    list(parallelmap.imap_loky(_task, _map_tasks(panel), max_workers=workers, progress_bar=False, chunksize='auto'))
+
+
+def _case_stream_loky(panel, workers):
+    for _ in parallelmap.stream_loky(_task, iter(_map_tasks(panel)), max_workers=workers, progress_bar=False,
+                                     chunksize='auto'):
+        pass
+
+
+def _case_map_thread(panel, workers):
+    parallelmap.map_thread(_task, _map_tasks(panel), max_workers=workers, progress_bar=False)
+
+
+## name: (function, whether it runs on several workers, maximum rows of the panel it runs on)
+## 名称: (函数, 是否多进程/线程运行, 使用的最大数据行数)
+CASES = {
+    'retutils.ret_pM_pN': (_case_ret_pM_pN, False, None),
+    'retutils.ret_m_K': (_case_ret_m_K, False, None),
+    'extpandas.parallel_groupby_apply.pickle': (_case_groupby_pickle, True, None),
+    'extpandas.parallel_groupby_apply.shared': (_case_groupby_shared, True, None),
+    'extpandas.parallel_rolling_apply.blocks': (_case_rolling_blocks, True, 50_000),
+    'parallelmap.map_loky': (_case_map_loky, True, None),
+    'parallelmap.imap_loky': (_case_imap_loky, True, None),
+    'parallelmap.stream_loky': (_case_stream_loky, True, None),
+    'parallelmap.map_thread': (_case_map_thread, True, None),
+}
+
+
+def measure(func: Callable, repeat: int = 3) -> dict:
+    """
+    Run func once to warm up (process pools, calendars), then repeat times for runtime,
+    and once more under tracemalloc for the peak memory allocated in the current process
+
+    :return: dictionary of best and median seconds, and peak bytes
+    """
+    func()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    ## tracemalloc slows down allocations, so the memory is measured in a separate run
+    ## tracemalloc会拖慢内存分配，因此单独运行一次测量内存
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'best': min(seconds), 'median': statistics.median(seconds), 'peak_bytes': peak}
+
+
+def run(sizes: list, workers: list, cases: Union[list, None] = None, repeat: int = 3, seed: int = 0,
+        calendar: str = 'SSE', verbose: bool = True) -> dict:
+    """
+    Run the benchmark cases over panel sizes and worker counts
+
+    :param sizes: list of (n_symbols, n_days)
+    :param workers: list of worker counts, cases running in a single process are measured once per size
+    :param cases: names of the cases in CASES, all by default
+    :return: dictionary with the environment in "meta" and one record per measurement in "results"
+    """
+    cases = list(CASES) if cases is None else cases
+    results = []
+    for n_symbols, n_days in sizes:
+        panel = synthetic_panel(n_symbols, n_days, calendar=calendar, seed=seed)
+        for name in cases:
+            func, parallel, max_rows = CASES[name]
+            data = panel if max_rows is None else panel.iloc[:max_rows]
+            for n_workers in (workers if parallel else [None]):
+                record = {'case': name, 'symbols': n_symbols, 'days': n_days, 'rows': len(data),
+                          'workers': n_workers, 'repeat': repeat}
+                record.update(measure(lambda: func(data, n_workers), repeat=repeat))
+                results.append(record)
+                if verbose:
+                    print(f"{name:45s} {n_symbols:>6d}x{n_days:<6d} workers={str(n_workers):4s} "
+                          f"best={record['best']:.4f}s peak={record['peak_bytes'] / 2 ** 20:.1f}MB", flush=True)
+    return {'meta': _environment(), 'results': results}
+
+
+def _environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def compare(current: dict, baseline: dict, threshold: float = 0.2, verbose: bool = True) -> list:
+    """
+    Compare benchmark results against a baseline, matching records by case, panel size and workers
+
+    :param threshold: a case regresses if its best runtime or peak memory exceeds the baseline by this ratio
+    :return: list of regressed records, each with the baseline values and the ratios
+    """
+    def _key(record):
+        return record['case'], record['symbols'], record['days'], record['workers']
+
+    baselines = {_key(record): record for record in baseline['results']}
+    regressions = []
+    for record in current['results']:
+        base = baselines.get(_key(record))
+        if base is None:
+            continue
+        time_ratio = record['best'] / base['best'] if base['best'] > 0 else float('inf')
+        memory_ratio = record['peak_bytes'] / base['peak_bytes'] if base['peak_bytes'] > 0 else 1.0
+        regressed = time_ratio > 1 + threshold or memory_ratio > 1 + threshold
+        if regressed:
+            regressions.append(dict(record, baseline_best=base['best'], baseline_peak_bytes=base['peak_bytes'],
+                                    time_ratio=time_ratio, memory_ratio=memory_ratio))
+        if verbose:
+            print(f"{record['case']:45s} {record['symbols']:>6d}x{record['days']:<6d} "
+                  f"workers={str(record['workers']):4s} time x{time_ratio:.2f} memory x{memory_ratio:.2f}"
+                  f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def _parse_sizes(text: str) -> list:
+    return [tuple(int(value) for value in size.split('x')) for size in text.split(',')]
+
+
+def main(argv: Union[list, None] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks of retutils, extpandas and parallelmap')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmarks and save the results as json')
+    run_parser.add_argument('--sizes', default='200x250,1000x1000', help='panel sizes as SYMBOLSxDAYS,...')
+    run_parser.add_argument('--workers', default='1,2,4', help='worker counts as N,...')
+    run_parser.add_argument('--cases', default=None, help=f'comma separated cases, all by default: {", ".join(CASES)}')
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--calendar', default='SSE')
+    run_parser.add_argument('--output', default='benchmark-results.json')
+    run_parser.add_argument('--baseline', default=None, help='compare against this baseline after running')
+    run_parser.add_argument('--threshold', type=float, default=0.2)
+
+    compare_parser = commands.add_parser('compare', help='flag regressions of results against a baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('--threshold', type=float, default=0.2)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        current = run(_parse_sizes(args.sizes), [int(n) for n in args.workers.split(',')],
+                      cases=None if args.cases is None else args.cases.split(','),
+                      repeat=args.repeat, seed=args.seed, calendar=args.calendar)
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+        if args.baseline is None:
+            return 0
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        with open(args.current) as f:
+            current = json.load(f)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    ## a non-zero exit code lets CI fail on regressions
+    ## 存在性能退化时返回非零退出码，便于CI检测
+    regressions = compare(current, baseline, threshold=args.threshold)
+    print(f'{len(regressions)} regression(s) over {args.threshold:.0%}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
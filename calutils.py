@@ -0,0 +1,223 @@
+from __future__ import annotations
+from typing import Union
+
+import contextlib
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+## bundled trading day calendars, one date per line
+## 内置交易日历，每行一个日期
+CALENDAR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trading-calendar')
+EXCHANGES = ('SSE', 'SZSE', 'HKEX', 'NYEX', 'NASDAQ')
+
+## compiled calendars are cached here, can be changed by the QUANTAMENTAL_CACHE_DIR environment variable
+## 编译后的交易日历缓存目录，可通过环境变量QUANTAMENTAL_CACHE_DIR修改
+CACHE_DIR = os.environ.get('QUANTAMENTAL_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'quantamental-toolbox'))
+
+_calendars = {}
+_lock = threading.Lock()
+
+
+def _resolve_path(name: str) -> str:
+    """
+    Resolve an exchange name ("SSE"), a bundled file name ("SSE.csv") or a path to a calendar csv file
+    """
+    stem = os.path.splitext(os.path.basename(name))[0].upper()
+    if name.upper() in EXCHANGES:
+        return os.path.join(CALENDAR_DIR, f'{name.upper()}.csv')
+    if os.path.exists(name):
+        return os.path.abspath(name)
+    if stem in EXCHANGES:
+        return os.path.join(CALENDAR_DIR, f'{stem}.csv')
+    raise FileNotFoundError(f"calendar {name!r} is neither a bundled exchange {EXCHANGES} nor an existing file")
+
+
+def _read_csv_days(path: str) -> np.ndarray:
+    """
+    Parse the calendar csv into sorted unique int64 day ordinals (days since 1970-01-01)
+    """
+    dates = pd.read_csv(path, header=None, parse_dates=[0])[0]
+    return np.unique(dates.to_numpy(dtype='datetime64[D]').view(np.int64))
+
+
+def _compile(path: str) -> np.ndarray:
+    """
+    Compile the calendar csv once into a binary .npy file and memory-map it, so that every instance and every
+    worker process shares the same pages. The compiled file is keyed by the path, size and modification time
+    of the source, written atomically so that concurrent processes never read a partial file, and replaces
+    the files compiled from older versions of the same source.
+    Falls back to an in-memory array if the cache directory is not writable.
+    """
+    stat = os.stat(path)
+    source = hashlib.md5(path.encode()).hexdigest()[:8]
+    version = hashlib.md5(f'{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()[:8]
+    prefix = os.path.join(CACHE_DIR, 'calendar', f'{os.path.splitext(os.path.basename(path))[0]}-{source}-')
+    compiled = f'{prefix}{version}.npy'
+    if not os.path.exists(compiled):
+        days = _read_csv_days(path)
+        tmp = None
+        try:
+            os.makedirs(os.path.dirname(compiled), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(compiled), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, days)
+            os.replace(tmp, compiled)
+        except OSError:
+            if tmp is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp)
+            return days
+        ## remove the files compiled from older versions of the same source, the processes that still map them
+        #   keep their pages until they exit
+        ## 删除同一源文件旧版本编译的文件，仍在映射这些文件的进程在退出前保留其内存页
+        for old in glob.glob(f'{glob.escape(prefix)}*.npy'):
+            if old != compiled:
+                with contextlib.suppress(OSError):
+                    os.remove(old)
+    return np.load(compiled, mmap_mode='r')
+
+
+def get_calendar(name: str = 'SSE') -> TradingCalendar:
+    """
+    Get the process-wide trading calendar of an exchange ("SSE", "SZSE", "HKEX", "NYEX", "NASDAQ") or a csv file,
+    the calendar is compiled and loaded only once per process
+    """
+    path = _resolve_path(name)
+    with _lock:
+        if path not in _calendars:
+            _calendars[path] = TradingCalendar(_compile(path), source=path)
+        return _calendars[path]
+
+
+def _to_days(dates) -> np.ndarray:
+    """
+    Convert dates (scalar, array, Series, DatetimeIndex or strings) to int64 day ordinals, NaT is kept as NaT
+    """
+    values = np.asarray(dates)
+    if values.dtype.kind != 'M':
+        values = np.asarray(pd.to_datetime(values.ravel())).reshape(values.shape)
+    return values.astype('datetime64[D]').view(np.int64)
+
+
+class TradingCalendar:
+    """
+    Trading day calendar stored as sorted int64 day ordinals (days since 1970-01-01), with vectorized helpers.
+    Calendars are shared through get_calendar, and pickled by source so worker processes map the same file.
+    """
+    NAT = np.datetime64('NaT').astype('datetime64[D]').view(np.int64)
+
+    def __init__(self, days: np.ndarray, source: Union[str, None] = None):
+        """
+        :param days: sorted int64 day ordinals
+        :param source: path of the csv file the calendar is compiled from
+        """
+        self.days = days
+        self.source = source
+        self._start_end = {}
+        self._fingerprint = None
+
+    def __reduce__(self):
+        if self.source is None:
+            return TradingCalendar, (np.asarray(self.days),)
+        return get_calendar, (self.source,)
+
+    def __len__(self):
+        return len(self.days)
+
+    @property
+    def fingerprint(self) -> str:
+        ## digest of the trading days, used as cache key
+        ## 交易日的摘要，用作缓存键
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.blake2b(np.ascontiguousarray(self.days).tobytes(), digest_size=16).hexdigest()
+        return self._fingerprint
+
+    def __repr__(self):
+        name = os.path.basename(self.source) if self.source else 'custom'
+        return f'TradingCalendar({name}, {self.dates[0]} ~ {self.dates[-1]}, {len(self)} days)'
+
+    @property
+    def dates(self) -> np.ndarray:
+        ## zero-copy datetime64[D] view of the day ordinals
+        return self.days.view('datetime64[D]')
+
+    def to_series(self) -> pd.Series:
+        return pd.Series(self.dates.astype('datetime64[ns]'))
+
+    def _take(self, pos: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        ## take the trading days at positions, NaT where the position is out of the calendar
+        pos = np.asarray(pos)
+        result = np.where(valid, self.days[np.clip(pos, 0, len(self.days) - 1)], self.NAT)
+        return result.view('datetime64[D]')
+
+    def positions(self, dates, side: str = 'left') -> np.ndarray:
+        """
+        Positions of dates in the calendar, i.e. the number of trading days before (side='left')
+        or not after (side='right') each date
+        """
+        return np.searchsorted(self.days, _to_days(dates), side=side)
+
+    def is_trading_day(self, dates) -> np.ndarray:
+        days = _to_days(dates)
+        pos = np.searchsorted(self.days, days).clip(0, len(self.days) - 1)
+        return self.days[pos] == days
+
+    def next_trading_day(self, dates, inclusive: bool = True) -> np.ndarray:
+        """
+        The first trading day after each date, or the date itself if inclusive and it is a trading day
+        """
+        days = _to_days(dates)
+        pos = np.searchsorted(self.days, days, side='left' if inclusive else 'right')
+        return self._take(pos, (pos < len(self.days)) & (days != self.NAT))
+
+    def prev_trading_day(self, dates, inclusive: bool = True) -> np.ndarray:
+        """
+        The last trading day before each date, or the date itself if inclusive and it is a trading day
+        """
+        days = _to_days(dates)
+        pos = np.searchsorted(self.days, days, side='right' if inclusive else 'left') - 1
+        return self._take(pos, (pos >= 0) & (days != self.NAT))
+
+    def offset(self, dates, n) -> np.ndarray:
+        """
+        The n-th trading day after (n > 0) or before (n < 0) each date, n = 0 rolls forward to the next trading day.
+        n can be a scalar or an array broadcast against dates.
+        """
+        days = _to_days(dates)
+        n = np.asarray(n)
+        pos = np.where(n > 0,
+                       np.searchsorted(self.days, days, side='right') + n - 1,
+                       np.searchsorted(self.days, days, side='left') + n)
+        return self._take(pos, (pos >= 0) & (pos < len(self.days)) & (days != self.NAT))
+
+    def start_end(self, key_day: int) -> pd.DataFrame:
+        """
+        The start and end trading days of each "month" separated by key_day: a month starts at the first trading day
+        not earlier than key_day of the calendar month, and ends at the last trading day before the next start.
+        The end of the last month is NaT.
+        """
+        if key_day not in self._start_end:
+            dates = self.dates
+            ## the key day of the month each trading day belongs to
+            ## 每个交易日所在月份的关键日期
+            key = dates.astype('datetime64[M]').astype('datetime64[D]') + (key_day - 1)
+            ## a trading day starts a month if it is not earlier than the key day while the previous one is earlier
+            ## 当日不早于关键日期且上一交易日早于关键日期，则为月份开始日
+            mask = np.zeros(len(dates), dtype=bool)
+            mask[1:] = (dates[1:] >= key[1:]) & (dates[:-1] < key[1:])
+            idx = np.flatnonzero(mask)
+
+            ## a month ends at the trading day before the next start
+            ## 月份结束日为下一开始日的前一交易日
+            end = np.full(len(idx), np.datetime64('NaT'), dtype='datetime64[D]')
+            end[:-1] = dates[idx[1:] - 1]
+            self._start_end[key_day] = pd.DataFrame({'start': dates[idx].astype('datetime64[ns]'),
+                                                     'end': end.astype('datetime64[ns]')}, index=idx)
+        return self._start_end[key_day].copy()
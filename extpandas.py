@@ -1,19 +1,32 @@
 from __future__ import annotations
-from typing import Union, Callable
+from typing import Union, Callable, Iterable
+
+import itertools
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 from pandas.core.groupby import DataFrameGroupBy, SeriesGroupBy
 from pandas.core.window.rolling import Rolling, RollingGroupby
 import numpy as np
+import cloudpickle
 import parallelmap
 from tqdm import tqdm
 
+logger = logging.getLogger(__name__)
+
 
 class SizedRolling:
     def __init__(self, rolling: Union[Rolling, RollingGroupby]):
         self.size = len(rolling.obj)
         self.rolling = rolling
         self.index = rolling.obj.index
+        self.window = rolling.window
         if rolling.min_periods is None:
             self.min_periods = rolling.window
         else:
@@ -26,59 +39,902 @@ class SizedRolling:
         return self.size
     ## write codes to let the iterator reset automately:
 
+    def segments(self) -> list:
+        """
+        Positions of the rows in rolling.obj that are rolled over independently: one array per group
+        for RollingGroupby, a single array of all rows for Rolling
+        """
+        if isinstance(self.rolling, RollingGroupby):
+            return list(self.rolling._grouper.indices.values())
+        return [np.arange(self.size)]
+
+
+## backend='auto' runs the first tasks itself to estimate the cost of each backend: about half of them one by one
+#   (compute time and pickled payload) and the others on threads (whether func releases the GIL)
+## backend='auto'先运行前几个任务估计各后端的耗时：约一半逐个运行（计算时间和序列化数据），其余在线程中运行（是否释放GIL）
+AUTO_SAMPLE_TASKS = 8
+AUTO_SAMPLE_SECONDS = 0.5
+## assumed fixed costs in seconds of a map on threads and on the reusable process pool
+## 线程和可复用进程池执行map的假定固定开销（秒）
+AUTO_THREAD_OVERHEAD = 0.002
+AUTO_PROCESS_OVERHEAD = 0.1
+## minimum compute seconds per worker, fewer workers are used for light workloads
+## 每个工作进程/线程的最少计算时间（秒），轻量任务使用更少的工作进程/线程
+AUTO_WORKER_SECONDS = 0.05
+
+BACKENDS = ('auto', 'serial', 'thread', 'process')
+
+
+def _auto_backend(func: Callable, tasks: list, max_workers: int, caller: str):
+    """
+    Choose the backend and the number of workers by running the first tasks
+    :return: (backend, number of workers, results of the first tasks)
+    """
+    results = []
+    start = time.perf_counter()
+    for task in tasks[:AUTO_SAMPLE_TASKS // 2]:
+        results.append(func(task))
+        if time.perf_counter() - start > AUTO_SAMPLE_SECONDS / 2:
+            break
+    compute = (time.perf_counter() - start) / max(len(results), 1)
+
+    ## the pickling and unpickling of tasks and results is paid in the parent for processes
+    ## 使用进程时，任务和结果的序列化与反序列化在主进程中进行
+    start = time.perf_counter()
+    payload = 0
+    for task, result in zip(tasks, results):
+        for obj in (task, result):
+            data = cloudpickle.dumps(obj)
+            cloudpickle.loads(data)
+            payload += len(data)
+    serialize = (time.perf_counter() - start) / max(len(results), 1)
+    payload /= max(len(results), 1)
+
+    ## run the next tasks on threads, the speedup shows how much of func runs without the GIL
+    ## 在线程中运行接下来的任务，加速比反映func释放GIL的程度
+    n_threads = min(max_workers, AUTO_SAMPLE_TASKS - len(results), len(tasks) - len(results))
+    speedup = 1.0
+    if n_threads >= 2 and compute * n_threads < AUTO_SAMPLE_SECONDS:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            results += list(executor.map(func, tasks[len(results):len(results) + n_threads]))
+        speedup = min(max(n_threads * compute / max(time.perf_counter() - start, 1e-9), 1.0), n_threads)
+
+    n_remaining = len(tasks) - len(results)
+    if n_remaining == 0:
+        logger.info("%s backend='auto' ran all %d tasks while sampling", caller, len(tasks))
+        return 'serial', 1, results
+    workers = int(min(max(n_remaining * compute / AUTO_WORKER_SECONDS, 1), max_workers, n_remaining))
+    thread_parallel = 1 + (speedup - 1) / (n_threads - 1) * (workers - 1) if n_threads >= 2 else 1.0
+    estimates = {'serial': n_remaining * compute,
+                 'thread': AUTO_THREAD_OVERHEAD + n_remaining * compute / thread_parallel,
+                 'process': AUTO_PROCESS_OVERHEAD + n_remaining * (compute / workers + serialize)}
+    backend = min(estimates, key=estimates.get)
+    if backend == 'serial':
+        workers = 1
+    logger.info("%s backend='auto' chose %s with %d worker(s) for %d tasks: %.3g ms compute and %.0f bytes "
+                "payload per task, thread speedup %.2f on %d threads, estimated seconds serial %.3g, "
+                "thread %.3g, process %.3g", caller, backend, workers, len(tasks), compute * 1e3, payload,
+                speedup, n_threads, estimates['serial'], estimates['thread'], estimates['process'])
+    return backend, workers, results
+
+
+def _map_backend(func: Callable,
+                 tasks: Iterable,
+                 backend: str = 'process',
+                 max_workers: int = parallelmap.CPU_COUNT,
+                 progress_bar: bool = True,
+                 caller: str = '',
+                 **kwargs) -> list:
+    """
+    Map func over the tasks in the current process ('serial'), on threads ('thread'), on the loky processes
+    ('process') or on the backend chosen by sampling the first tasks ('auto')
+
+    :param kwargs: key arguments passed to parallelmap.map_loky_raw, only supported by the process backend,
+        'auto' then always chooses the process backend
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
+    ## the options of the loky processes (telemetry, chunksize, executor arguments) are not silently dropped
+    ## 进程池选项（telemetry、chunksize、进程池参数）不被静默忽略
+    if kwargs and backend in ('serial', 'thread'):
+        raise TypeError(f"{caller} backend={backend!r} does not support {', '.join(kwargs)}, "
+                        f"only backend='process' does")
+    if kwargs and backend == 'auto':
+        logger.info("%s backend='auto' chose process for the options %s", caller, ', '.join(kwargs))
+        backend = 'process'
+    if backend == 'process':
+        return parallelmap.map_loky_raw(func, tasks, max_workers=max_workers, progress_bar=progress_bar, **kwargs)
+    tasks = list(tasks)
+    results = []
+    if backend == 'auto':
+        backend, max_workers, results = _auto_backend(func, tasks, max_workers, caller)
+    tasks = tasks[len(results):]
+    if backend == 'serial':
+        results += [func(task) for task in tqdm(tasks, disable=not progress_bar)]
+    elif backend == 'thread':
+        results += list(parallelmap.map_thread(func, tasks, max_workers=max_workers, progress_bar=progress_bar))
+    else:
+        results += parallelmap.map_loky_raw(func, tasks, max_workers=max_workers, progress_bar=progress_bar,
+                                            **kwargs)
+    return results
+
 
 def parallel_groupby_apply(grouped: Union[DataFrameGroupBy, SeriesGroupBy],
                            func: Callable,
+                           transport: str = 'pickle',
+                           output: Union[str, None] = None,
+                           backend: str = 'process',
                            **kwargs):
     """
     This function is used to parallelize the calculation of groupby apply
+
+    :param backend: 'process' runs func on the loky processes, 'thread' on threads (no serialization, for functions
+        releasing the GIL such as numpy work), 'serial' in the current process, and 'auto' chooses among them and
+        the number of workers by sampling the first groups, the choice is logged by the "extpandas" logger;
+        transport='shared' always runs on processes
+    :param transport: 'pickle' sends every group to the workers and concatenates the results,
+        'shared' places the column arrays in a memory-mapped file once, sends only group offset ranges to the workers
+        and lets them write numeric results into a preallocated shared output buffer
+    :param output: only for transport='shared', 'transform' if func returns one row per input row,
+        'aggregate' if func returns a scalar or a fixed length Series per group, inferred from the first group if None
+    :param kwargs: key arguments passed to parallelmap.map_loky_raw,
+        e.g. telemetry=parallelmap.Telemetry() also times the split and concat phases,
+        only supported by the process backend, 'auto' then always chooses it
+    """
+    if transport == 'shared':
+        if backend not in ('process', 'auto'):
+            raise ValueError(f"transport='shared' requires backend 'process' or 'auto', got {backend!r}")
+        return _shared_groupby_apply(grouped, func, output=output, **kwargs)
+    elif transport != 'pickle':
+        raise ValueError(f"unknown transport {transport!r}, expected 'pickle' or 'shared'")
+    telemetry = kwargs.get('telemetry')
+    with parallelmap.phase(telemetry, 'split'):
+        groups = [group for name, group in grouped]
+    result = _map_backend(func, groups, backend=backend, caller='parallel_groupby_apply', **kwargs)
+    with parallelmap.phase(telemetry, 'concat'):
+        result = pd.concat(result)
+    return result
+
+
+## the shared memory transport of parallel_groupby_apply
+## parallel_groupby_apply的共享内存传输实现
+
+## the shared files are placed in /dev/shm (RAM backed) when available
+## 优先使用内存文件系统/dev/shm存放共享文件
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+def _encode_values(values: np.ndarray):
+    """
+    Encode values into a memory-mappable array: numeric values are kept, datetimes are viewed as int64,
+    other values (strings, objects, categories) are factorized into codes with the uniques kept aside
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'biufc':
+        return values, ('raw', None)
+    if values.dtype.kind in 'mM':
+        return values.view(np.int64), ('view', values.dtype)
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    return codes, ('codes', uniques)
+
+
+def _decode_values(array: np.ndarray, encoding: tuple):
+    kind, meta = encoding
+    if kind == 'raw':
+        return array
+    if kind == 'view':
+        return array.view(meta)
+    return meta.take(array)
+
+
+def _write_shared(directory: str, name: str, values: np.ndarray):
+    array = np.lib.format.open_memmap(os.path.join(directory, f'{name}.npy'), mode='w+',
+                                      dtype=values.dtype, shape=values.shape)
+    array[:] = values
+    array.flush()
+
+
+def _load_shared(directory: str):
+    """
+    Map the shared arrays of a directory in the worker process
+    """
+    with open(os.path.join(directory, 'spec.pkl'), 'rb') as f:
+        spec = pickle.load(f)
+    arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+              for name in ['order', 'offsets'] + [f'col{i}' for i in range(len(spec['columns']))] + ['index']}
+    arrays['out'] = np.load(os.path.join(directory, 'out.npy'), mmap_mode='r+')
+    return spec, arrays
+
+
+def _shared_group(spec: dict, arrays: dict, start: int, stop: int):
+    """
+    Rebuild the group of rows [start, stop) of the group-contiguous layout from zero-copy slices
+    """
+    index = pd.Index(_decode_values(arrays['index'][start:stop], spec['index']), name=spec['index_name'])
+    values = [_decode_values(arrays[f'col{i}'][start:stop], encoding) for i, encoding in enumerate(spec['columns'])]
+    if spec['series']:
+        return pd.Series(values[0], index=index, name=spec['names'][0], copy=False)
+    return pd.DataFrame(dict(zip(range(len(values)), values)), index=index, copy=False).set_axis(spec['names'], axis=1)
+
+
+def _shared_group_worker(item):
+    """
+    Apply func to the groups [item[2], item[3]) and write the results into the shared output buffer
+    :param item: (shared directory, func, first group, last group + 1)
     """
-    result = pd.concat(parallelmap.map_loky_raw(func, [group for name, group in grouped], **kwargs))
+    directory, func, group_start, group_stop = item
+    spec, arrays = _load_shared(directory)
+    try:
+        offsets, order, out = arrays['offsets'], arrays['order'], arrays['out']
+        for g in range(group_start, group_stop):
+            start, stop = offsets[g], offsets[g + 1]
+            result = np.asarray(func(_shared_group(spec, arrays, start, stop)), dtype=np.float64)
+            if spec['output'] == 'transform':
+                ## write at the original row positions, so no reordering is needed afterwards
+                ## 直接写入原始行位置，之后无需重新排序
+                out[order[start:stop]] = result.reshape((stop - start,) + out.shape[1:])
+            else:
+                out[g] = result.reshape(out.shape[1:])
+        out.flush()
+    finally:
+        ## release the mappings at the end of every task: the parent removes the files after the last task,
+        #   and a mapping kept by an idle worker would pin their memory in /dev/shm
+        ## 每个任务结束时释放内存映射：父进程在最后一个任务后删除文件，空闲进程保留映射会占用/dev/shm内存
+        arrays.clear()
+        offsets = order = out = result = None
+    return group_stop - group_start
+
+
+def _shared_groupby_apply(grouped: Union[DataFrameGroupBy, SeriesGroupBy],
+                          func: Callable,
+                          output: Union[str, None] = None,
+                          max_workers: int = parallelmap.CPU_COUNT,
+                          **kwargs):
+    obj = grouped._selected_obj
+    codes = grouped.ngroup().to_numpy(dtype=np.float64, na_value=np.nan)
+    codes = np.where(np.isnan(codes), -1, codes).astype(np.int64)
+    n_groups = int(codes.max(initial=-1)) + 1
+
+    ## group-contiguous layout: group g occupies rows [offsets[g], offsets[g+1]) of order
+    ## 按分组连续排列：第g组位于order的[offsets[g], offsets[g+1])
+    order = np.argsort(codes, kind='stable')
+    offsets = np.searchsorted(codes, np.arange(n_groups + 1), sorter=order)
+    if n_groups == 0:
+        return pd.Series(dtype=np.float64)
+
+    series = isinstance(obj, pd.Series)
+    columns = [obj.to_numpy()] if series else [obj.iloc[:, i].to_numpy() for i in range(obj.shape[1])]
+    names = [obj.name] if series else list(obj.columns)
+    index = obj.index
+    if isinstance(index, pd.MultiIndex):
+        index = pd.RangeIndex(len(obj))
+
+    ## infer the output shape from the first group
+    ## 以第一组的结果推断输出形状
+    first = func(obj.iloc[order[offsets[0]:offsets[1]]])
+    first_values = np.asarray(first)
+    if first_values.dtype.kind not in 'biuf':
+        raise TypeError(f"transport='shared' requires numeric results, got {first_values.dtype}")
+    if output is None:
+        output = 'transform' if first_values.ndim >= 1 and len(first_values) == offsets[1] - offsets[0] \
+            else 'aggregate'
+    if output == 'transform':
+        shape = (len(obj),) if first_values.ndim <= 1 else (len(obj), first_values.shape[1])
+    elif output == 'aggregate':
+        shape = (n_groups,) if first_values.ndim == 0 else (n_groups, first_values.size)
+    else:
+        raise ValueError(f"unknown output {output!r}, expected 'transform' or 'aggregate'")
+
+    directory = tempfile.mkdtemp(prefix='extpandas-', dir=SHARED_DIR)
+    try:
+        ## place the arrays in the shared directory once, in the group-contiguous layout
+        ## 将数组按分组连续顺序一次性写入共享目录
+        with parallelmap.phase(kwargs.get('telemetry'), 'shared write'):
+            encodings = []
+            for i, values in enumerate(columns):
+                array, encoding = _encode_values(values)
+                _write_shared(directory, f'col{i}', array[order])
+                encodings.append(encoding)
+            array, index_encoding = _encode_values(index.to_numpy())
+            _write_shared(directory, 'index', array[order])
+            _write_shared(directory, 'order', order)
+            _write_shared(directory, 'offsets', offsets)
+            out = np.lib.format.open_memmap(os.path.join(directory, 'out.npy'), mode='w+', dtype=np.float64,
+                                            shape=shape)
+            out[:] = np.nan
+            out.flush()
+            with open(os.path.join(directory, 'spec.pkl'), 'wb') as f:
+                pickle.dump({'columns': encodings, 'names': names, 'series': series, 'index': index_encoding,
+                             'index_name': index.name, 'output': output}, f)
+
+        ## split the groups into about 4 tasks per worker with balanced row counts
+        ## 将分组按行数均衡切分，每个进程约4个任务
+        n_tasks = min(n_groups, max_workers * 4)
+        bounds = np.searchsorted(offsets, np.linspace(offsets[0], offsets[-1], n_tasks + 1)[1:-1])
+        bounds = np.unique(np.concatenate([[0], bounds, [n_groups]]))
+        tasks = [(directory, func, bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+        parallelmap.map_loky_raw(_shared_group_worker, tasks, max_workers=max_workers, **kwargs)
+    finally:
+        ## the output buffer stays mapped after its file is removed
+        ## 文件删除后输出缓冲区的内存映射依然有效
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if output == 'transform':
+        if len(shape) == 1:
+            return pd.Series(out, index=obj.index, name=obj.name if series else None, copy=False)
+        return pd.DataFrame(out, index=obj.index, columns=getattr(first, 'columns', None), copy=False)
+    keys = grouped.size().index
+    if len(shape) == 1:
+        return pd.Series(out, index=keys, copy=False)
+    return pd.DataFrame(out, index=keys, columns=getattr(first, 'index', None), copy=False)
+
+
+def _concat_rolling_results(result: list, index: pd.Index):
+    ## check the type of result & concat the result
+    if isinstance(result[0], pd.Series):
+        result = pd.concat(result, axis=1).T
+        result.index = index
+    elif isinstance(result[0], pd.DataFrame):
+        result = pd.concat(result)
+        result.index = index
+    else:
+        result = pd.Series(result, index=index)
     return result
 
 
 def rolling_apply(rolling: Union[Rolling, RollingGroupby],
                   func: Callable,
                   progress_bar=True,
+                  raw: bool = False,
+                  vectorized: bool = False,
+                  columns: Union[list, None] = None,
                   ):
     """
     This function is used to rolling-apply the DataFrame, support multi-columns
+
+    :param raw: if True, func receives zero-copy numpy views of shape (window, n_columns) (or (window,) for Series)
+        taken from a sliding window view, and returns a scalar or a 1-D array; only fixed integer windows are supported
+    :param vectorized: only with raw=True, func receives a whole stack of windows of shape (n_windows, window, ...)
+        and returns an array of shape (n_windows,) or (n_windows, n_outputs)
+    :param columns: only with raw=True, names of the outputs, default the input columns if func returns one value
+        per input column
     """
     rolling = SizedRolling(rolling)
+    if raw:
+        return _rolling_apply_raw(rolling, func, progress_bar, vectorized, columns)
     if progress_bar:
         result = list(tqdm(map(func, rolling), total=len(rolling)))
     else:
         result = list(map(func, rolling))
 
-    ## check the type of result & concat the result
-    if isinstance(result[0], pd.Series):
-        result = pd.concat(result, axis=1).T
-        result.index = rolling.index
-    elif isinstance(result[0], pd.DataFrame):
-        result = pd.concat(result)
-        result.index = rolling.index
-    else:
-        result = pd.Series(result, index=rolling.index)
+    result = _concat_rolling_results(result, rolling.index)
     result.iloc[:rolling.min_periods - 1] = np.nan
     return result
 
 
+def _rolling_apply_raw(rolling: SizedRolling,
+                       func: Callable,
+                       progress_bar: bool = True,
+                       vectorized: bool = False,
+                       columns: Union[list, None] = None):
+    raw = rolling.rolling
+    if not isinstance(rolling.window, (int, np.integer)) or raw.center or raw.win_type is not None:
+        raise ValueError("raw=True is only supported for fixed integer windows without center or win_type")
+    window = int(rolling.window)
+    obj = raw.obj
+    values = obj.to_numpy()
+    out = None
+
+    def _store(positions, result):
+        ## preallocate the output once the width of the results is known
+        ## 得到第一个结果后预分配输出数组
+        nonlocal out
+        result = np.asarray(result, dtype=np.float64)
+        if out is None:
+            out = np.full((rolling.size,) + result.shape[1 if vectorized else 0:], np.nan)
+        out[positions] = result
+
+    with tqdm(total=rolling.size, disable=not progress_bar) as bar:
+        for positions in rolling.segments():
+            segment = values if len(positions) == rolling.size and positions[-1] == rolling.size - 1 \
+                else values[positions]
+            first = min(rolling.min_periods, window) - 1
+
+            ## partial windows at the beginning of the segment, with at least min_periods rows
+            ## 分段开头不足window行但不少于min_periods行的窗口
+            for i in range(first, min(window - 1, len(positions))):
+                result = func(segment[None, :i + 1]) if vectorized else func(segment[:i + 1])
+                _store(positions[i:i + 1] if vectorized else positions[i], result)
+
+            ## full windows as zero-copy strided views of shape (n_windows, window, ...)
+            ## 完整窗口为零拷贝的滑动窗口视图
+            if len(positions) >= window:
+                windows = np.lib.stride_tricks.sliding_window_view(segment, window, axis=0)
+                if windows.ndim == 3:
+                    windows = windows.transpose(0, 2, 1)
+                if vectorized:
+                    _store(positions[window - 1:], func(windows))
+                else:
+                    for i, w in enumerate(windows):
+                        _store(positions[window - 1 + i], func(w))
+            bar.update(len(positions))
+
+    if out is None:
+        return pd.Series(np.nan, index=rolling.index)
+    if out.ndim == 1:
+        return pd.Series(out, index=rolling.index, copy=False)
+    if columns is None and isinstance(obj, pd.DataFrame) and out.shape[1] == obj.shape[1]:
+        columns = obj.columns
+    return pd.DataFrame(out, index=rolling.index, columns=columns, copy=False)
+
+
+def _rolling_block(item):
+    """
+    Rebuild the windows of a block locally and apply func to them
+    :param item: (func, block data including window - 1 rows of overlap before the block, window, overlap rows)
+    :return: results of the windows ending in the block
+    """
+    func, data, window, overlap = item
+    return [func(w) for w in itertools.islice(data.rolling(window), overlap, None)]
+
+
 def parallel_rolling_apply(rolling: Union[Rolling, RollingGroupby],
                            func: Callable,
+                           blocks: Union[int, str, None] = None,
+                           backend: str = 'process',
                            **kwargs):
     """
     This function is used to parallelize the calculation of rolling apply, support multi-columns
+
+    :param blocks: if None, every window is sent to the workers separately;
+        else the rows are split into this number of contiguous blocks ('auto' for 4 blocks per worker),
+        each sent with window - 1 rows of overlap so the workers rebuild the windows locally.
+        Blocks of RollingGroupby never cross group boundaries. Only fixed integer windows are supported.
+    :param backend: 'process', 'thread', 'serial' or 'auto', see parallel_groupby_apply
+    :param kwargs: key arguments passed to parallelmap.map_loky_raw, only supported by the process backend
     """
     rolling = SizedRolling(rolling)
-    result = parallelmap.map_loky_raw(func, rolling, **kwargs)
+    if blocks is not None:
+        return _parallel_rolling_apply_blocks(rolling, func, blocks, backend=backend, **kwargs)
+    result = _map_backend(func, rolling, backend=backend, caller='parallel_rolling_apply', **kwargs)
 
-    if isinstance(result[0], pd.Series):
-        result = pd.concat(result, axis=1).T
-        result.index = rolling.index
-    elif isinstance(result[0], pd.DataFrame):
-        result = pd.concat(result)
-        result.index = rolling.index
-    else:
-        result = pd.Series(result, index=rolling.index)
+    with parallelmap.phase(kwargs.get('telemetry'), 'concat'):
+        result = _concat_rolling_results(result, rolling.index)
     result.iloc[:rolling.min_periods - 1] = np.nan
     return result
+
+
+def _parallel_rolling_apply_blocks(rolling: SizedRolling,
+                                   func: Callable,
+                                   blocks: Union[int, str],
+                                   max_workers: int = parallelmap.CPU_COUNT,
+                                   backend: str = 'process',
+                                   **kwargs):
+    raw = rolling.rolling
+    if not isinstance(rolling.window, (int, np.integer)) or raw.center or raw.win_type is not None:
+        raise ValueError("blocks are only supported for fixed integer windows without center or win_type")
+    if blocks == 'auto':
+        blocks = max_workers * 4
+    obj = raw.obj
+    window = int(rolling.window)
+    block_size = max(1, -(-rolling.size // int(blocks)))
+
+    ## split each segment into blocks, each block carrying window - 1 rows of overlap within the segment
+    ## 将每个分段切分为连续的块，每块带有分段内window - 1行的重叠数据
+    tasks, block_positions = [], []
+    segments = rolling.segments()
+    for positions in segments:
+        for start in range(0, len(positions), block_size):
+            stop = min(start + block_size, len(positions))
+            lo = max(start - window + 1, 0)
+            tasks.append((func, obj.iloc[positions[lo:stop]], window, start - lo))
+            block_positions.append(positions[start:stop])
+    result = _map_backend(_rolling_block, tasks, backend=backend, max_workers=max_workers,
+                          caller='parallel_rolling_apply', **kwargs)
+
+    ## stitch the blocks back in the order of rolling.obj
+    ## 按原数据顺序拼接各块结果
+    positions = np.concatenate(block_positions)
+    order = np.argsort(positions, kind='stable')
+    result = [value for block in result for value in block]
+    with parallelmap.phase(kwargs.get('telemetry'), 'concat'):
+        result = _concat_rolling_results([result[i] for i in order], pd.RangeIndex(len(positions)))
+    result.index = positions[order]
+    if len(positions) < rolling.size:
+        result = result.reindex(np.arange(rolling.size))
+    result.index = rolling.index
+
+    ## the windows with fewer than min_periods rows of each segment are NaN
+    ## 每个分段中不足min_periods行的窗口结果为NaN
+    for positions in segments:
+        result.iloc[positions[:rolling.min_periods - 1]] = np.nan
+    return result
+
+
+## number of rows processed at once by rolling_ols, bounding the memory of the sufficient statistics
+## rolling_ols每次处理的行数，限制充分统计量占用的内存
+ROLLING_OLS_CHUNK = 1 << 16
+
+
+def _group_codes(data: pd.DataFrame, by: Union[str, list]):
+    """
+    Group code of each row in order of appearance, -1 for rows with a missing key, and the number of groups
+    """
+    codes = data.groupby(by, sort=False).ngroup().to_numpy(dtype=np.float64, na_value=np.nan)
+    codes = np.where(np.isnan(codes), -1, codes).astype(np.int64)
+    return codes, int(codes.max(initial=-1)) + 1
+
+
+def _window_sums(values: np.ndarray, lo: np.ndarray, hi: np.ndarray):
+    """
+    Sums of values[lo:hi] along the first axis for every pair of bounds, by differences of prefix sums
+    """
+    prefix = np.zeros((len(values) + 1,) + values.shape[1:])
+    np.cumsum(values, axis=0, out=prefix[1:])
+    return prefix[hi] - prefix[lo]
+
+
+def rolling_ols(data: pd.DataFrame,
+                y: str,
+                x: Union[str, list],
+                window: int,
+                min_periods: Union[int, None] = None,
+                add_constant: bool = True,
+                by: Union[str, list, None] = None):
+    """
+    Rolling (and grouped rolling) OLS regression of y on x.
+    The sufficient statistics X'X, X'y, y'y and the number of observations are updated as rows enter
+    and leave the window (by differences of prefix sums), so the cost per row is O(k^2) instead of O(window * k^2),
+    then all the windows are solved at once. Rows with NaN in y or x are left out of the windows.
+
+    :param data: DataFrame with y and x columns, rows of each group in time order
+    :param y: name of the dependent variable
+    :param x: name(s) of the regressors
+    :param window: number of rows in each window
+    :param min_periods: minimum number of valid observations in a window to have a result, default window
+    :param add_constant: add an intercept named "const"
+    :param by: column(s) to group by, windows never cross groups
+    :return: DataFrame aligned with data, with columns beta_{name} and t_{name} for each regressor,
+        r2 (centered if add_constant), resid_vol (standard deviation of residuals) and nobs
+    """
+    x = [x] if isinstance(x, str) else list(x)
+    names = (['const'] if add_constant else []) + x
+    k = len(names)
+    n = len(data)
+    min_periods = window if min_periods is None else min_periods
+
+    ## group-contiguous layout, keeping the row order inside each group
+    ## 按分组连续排列，保持分组内部行顺序
+    if by is None:
+        order = None
+        group_start = np.zeros(n, dtype=np.int64)
+    else:
+        codes, _ = _group_codes(data, by)
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+        first = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        group_start = np.repeat(first, np.diff(np.r_[first, n]))
+
+    X = data[x].to_numpy(dtype=np.float64)
+    Y = data[y].to_numpy(dtype=np.float64)
+    if order is not None:
+        X, Y = X[order], Y[order]
+    if add_constant:
+        X = np.column_stack([np.ones(n), X])
+    valid = ~np.isnan(Y) & ~np.isnan(X).any(axis=1)
+    if by is not None:
+        valid &= sorted_codes >= 0
+    X = np.where(valid[:, None], X, 0.0)
+    Y = np.where(valid, Y, 0.0)
+    iu, ju = np.triu_indices(k)
+
+    result = np.full((n, 2 * k + 3), np.nan)
+    for a in range(0, n, ROLLING_OLS_CHUNK):
+        b = min(a + ROLLING_OLS_CHUNK, n)
+        ## local rows start window rows earlier, so every window of the chunk lies in them
+        ## 局部数据向前多取window行，使本块的每个窗口都在其中
+        a0 = max(a - window, 0)
+        rows = np.arange(a, b)
+        lo = np.maximum(rows - window + 1, group_start[a:b]) - a0
+        hi = rows + 1 - a0
+        Xl, Yl = X[a0:b], Y[a0:b]
+
+        nobs = _window_sums(valid[a0:b].astype(np.float64), lo, hi)
+        sxx = _window_sums(Xl[:, iu] * Xl[:, ju], lo, hi)
+        sxy = _window_sums(Xl * Yl[:, None], lo, hi)
+        syy = _window_sums(Yl * Yl, lo, hi)
+        sy = _window_sums(Yl, lo, hi)
+
+        ## windows with fewer than min_periods observations (or no degree of freedom) only report nobs
+        ## 观测数不足min_periods（或无自由度）的窗口只返回nobs
+        result[a:b, -1] = nobs
+        ok = np.flatnonzero(nobs >= max(min_periods, k + 1))
+        if len(ok) == 0:
+            continue
+        xtx = np.empty((len(ok), k, k))
+        xtx[:, iu, ju] = sxx[ok]
+        xtx[:, ju, iu] = sxx[ok]
+
+        ## invert X'X by eigen-decomposition, rank deficient windows are left NaN
+        ## 以特征分解求X'X的逆，秩亏窗口结果为NaN
+        w, v = np.linalg.eigh(xtx)
+        full_rank = w[:, 0] > w[:, -1] * k * np.finfo(np.float64).eps
+        w = np.where(full_rank[:, None], w, 1.0)
+        inv = (v / w[:, None, :]) @ v.transpose(0, 2, 1)
+        beta = np.einsum('mij,mj->mi', inv, sxy[ok])
+
+        n_ok = nobs[ok]
+        ssr = np.maximum(syy[ok] - np.einsum('mi,mi->m', beta, sxy[ok]), 0.0)
+        sst = syy[ok] - sy[ok] ** 2 / n_ok if add_constant else syy[ok]
+        s2 = ssr / (n_ok - k)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tvalues = beta / np.sqrt(np.diagonal(inv, axis1=1, axis2=2) * s2[:, None])
+            r2 = 1.0 - ssr / sst
+        out = np.column_stack([beta, tvalues, r2, np.sqrt(s2), n_ok])
+        out[~full_rank, :-1] = np.nan
+        result[a + ok] = out
+
+    if order is not None:
+        unsorted = np.empty_like(result)
+        unsorted[order] = result
+        result = unsorted
+    columns = [f'beta_{name}' for name in names] + [f't_{name}' for name in names] + ['r2', 'resid_vol', 'nobs']
+    return pd.DataFrame(result, index=data.index, columns=columns)
+
+
+## vectorized cross-sectional transforms: every group (e.g. date) is processed at once with group codes,
+#   bincount sums and one sort by (group, value), without any process pool
+## 向量化截面变换：以分组编码、bincount求和及按(分组, 数值)一次排序处理全部分组（如日期），无需进程池
+
+def _columns(columns: Union[str, list]) -> list:
+    return [columns] if isinstance(columns, str) else list(columns)
+
+
+def _sort_within_groups(values: np.ndarray, codes: np.ndarray, n_groups: int, stable: bool = False):
+    """
+    Rows with a group and a non-NaN value, sorted by group then value (tied values in row order if stable),
+    with the number of such rows and the start of each group in the sorted rows
+    """
+    rows = np.flatnonzero((codes >= 0) & ~np.isnan(values))
+    rows = rows[np.argsort(values[rows], kind='stable' if stable else None)]
+    ## the stable sort by group is a radix sort when the codes fit in 16 bits
+    ## 分组编码不超过16位时，按分组的稳定排序为基数排序
+    group = codes[rows].astype(np.uint16) if n_groups <= np.iinfo(np.uint16).max else codes[rows]
+    rows = rows[np.argsort(group, kind='stable')]
+    counts = np.bincount(codes[rows], minlength=n_groups)
+    return rows, counts, np.cumsum(counts) - counts
+
+
+def _grouped_quantile(values: np.ndarray, codes: np.ndarray, n_groups: int, q: float) -> np.ndarray:
+    """
+    Quantile of each group with linear interpolation as pandas, NaN for groups without values
+    """
+    rows, counts, starts = _sort_within_groups(values, codes, n_groups)
+    sorted_values = np.append(values[rows], np.nan)
+    h = (counts - 1) * q
+    lo = np.floor(h).astype(np.int64)
+    hi = np.minimum(lo + 1, counts - 1)
+    with np.errstate(invalid='ignore'):
+        result = sorted_values[np.where(counts > 0, starts + lo, -1)]
+        result += (h - lo) * (sorted_values[np.where(counts > 0, starts + hi, -1)] - result)
+    return result
+
+
+def _grouped_mean(values: np.ndarray, codes: np.ndarray, valid: np.ndarray, n_groups: int):
+    counts = np.bincount(codes[valid], minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.bincount(codes[valid], weights=values[valid], minlength=n_groups) / counts, counts
+
+
+def grouped_zscore(data: pd.DataFrame,
+                   columns: Union[str, list],
+                   by: Union[str, list],
+                   ddof: int = 1) -> pd.DataFrame:
+    """
+    Standardize each column within each group: (x - mean) / std, NaN values are left out
+
+    :param columns: name(s) of the columns to transform
+    :param by: column(s) to group by, e.g. the date for cross-sectional standardization
+    :param ddof: delta degrees of freedom of the standard deviation
+    :return: DataFrame aligned with data with the transformed columns, NaN for groups with zero variance
+    """
+    codes, n_groups = _group_codes(data, by)
+    result = {}
+    for col in _columns(columns):
+        values = data[col].to_numpy(dtype=np.float64)
+        valid = (codes >= 0) & ~np.isnan(values)
+        mean, counts = _grouped_mean(values, codes, valid, n_groups)
+        ## two passes for precision: the squared deviations from the group mean
+        ## 两遍计算以保证精度：先求均值再求离差平方和
+        deviation = np.where(valid, values - mean[codes], np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(np.bincount(codes[valid], weights=deviation[valid] ** 2, minlength=n_groups)
+                          / (counts - ddof))
+            std[(counts - ddof <= 0) | (std == 0)] = np.nan
+            result[col] = deviation / std[codes]
+    return pd.DataFrame(result, index=data.index)
+
+
+def grouped_rank(data: pd.DataFrame,
+                 columns: Union[str, list],
+                 by: Union[str, list],
+                 method: str = 'average',
+                 pct: bool = False,
+                 ascending: bool = True) -> pd.DataFrame:
+    """
+    Rank each column within each group as pandas groupby rank, NaN values keep NaN
+
+    :param method: 'average', 'min', 'max', 'first' or 'dense' rank of tied values
+    :param pct: if True, return the rank divided by the number of values (of distinct values for 'dense')
+    :param ascending: rank in ascending order
+    """
+    if method not in ('average', 'min', 'max', 'first', 'dense'):
+        raise ValueError(f"unknown method {method!r}, expected 'average', 'min', 'max', 'first' or 'dense'")
+    codes, n_groups = _group_codes(data, by)
+    result = {}
+    for col in _columns(columns):
+        result[col] = _rank_values(data[col].to_numpy(dtype=np.float64), codes, n_groups, method, pct, ascending)
+    return pd.DataFrame(result, index=data.index)
+
+
+def _rank_values(values: np.ndarray, codes: np.ndarray, n_groups: int, method: str, pct: bool, ascending: bool):
+    rows, counts, starts = _sort_within_groups(values if ascending else -values, codes, n_groups,
+                                               stable=method == 'first')
+    sorted_values, sorted_codes = values[rows], codes[rows]
+    group_start = starts[sorted_codes]
+
+    ## runs of tied values in the same group
+    ## 同一分组内取值相同的连续区间
+    new_run = np.ones(len(rows), dtype=bool)
+    new_run[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_codes[1:] != sorted_codes[:-1])
+    run_id = np.cumsum(new_run) - 1
+    run_start = np.flatnonzero(new_run)
+    run_end = np.append(run_start[1:], len(rows))
+    if method == 'average':
+        ranks = (run_start[run_id] + run_end[run_id] + 1) / 2 - group_start
+    elif method == 'min':
+        ranks = run_start[run_id] + 1 - group_start
+    elif method == 'max':
+        ranks = run_end[run_id] - group_start
+    elif method == 'first':
+        ranks = np.arange(len(rows)) + 1 - group_start
+    else:
+        ranks = run_id - run_id[group_start] + 1
+    ranks = ranks.astype(np.float64)
+    if pct:
+        if method == 'dense':
+            ## the number of distinct values of each group is the dense rank of its last row
+            ## 每组不同取值的个数为其最后一行的dense排名
+            n_distinct = np.zeros(n_groups)
+            n_distinct[sorted_codes] = ranks
+            ranks /= n_distinct[sorted_codes]
+        else:
+            ranks /= counts[sorted_codes]
+    result = np.full(len(values), np.nan)
+    result[rows] = ranks
+    return result
+
+
+def grouped_qcut(data: pd.DataFrame,
+                 columns: Union[str, list],
+                 by: Union[str, list],
+                 q: int = 10) -> pd.DataFrame:
+    """
+    Quantile bucket (0 to q - 1) of each column within each group, e.g. for portfolio sorts,
+    as pd.qcut(labels=False) on the minimum ranks of the values, so that tied values always fall into
+    the same bucket and duplicated edges never raise; NaN values keep NaN
+    """
+    codes, n_groups = _group_codes(data, by)
+    result = {}
+    for col in _columns(columns):
+        values = data[col].to_numpy(dtype=np.float64)
+        ranks = _rank_values(values, codes, n_groups, 'min', False, True)
+        counts = np.bincount(codes[~np.isnan(ranks)], minlength=n_groups)
+        ## the bucket edges of pd.qcut on ranks 1..count are 1 + j * (count - 1) / q, closed on the right
+        ## pd.qcut对排名1..count的分位点为1 + j * (count - 1) / q，区间右闭
+        with np.errstate(invalid='ignore', divide='ignore'):
+            buckets = np.ceil((ranks - 1) * q / (counts[codes] - 1)) - 1
+        result[col] = np.where(np.isnan(ranks), np.nan, np.clip(np.nan_to_num(buckets, nan=0.0), 0, q - 1))
+    return pd.DataFrame(result, index=data.index)
+
+
+def grouped_winsorize(data: pd.DataFrame,
+                      columns: Union[str, list],
+                      by: Union[str, list],
+                      lower: float = 0.01,
+                      upper: float = 0.99) -> pd.DataFrame:
+    """
+    Clip each column within each group to its lower and upper quantiles (linear interpolation as pandas)
+    """
+    codes, n_groups = _group_codes(data, by)
+    result = {}
+    for col in _columns(columns):
+        values = data[col].to_numpy(dtype=np.float64)
+        low = np.append(_grouped_quantile(values, codes, n_groups, lower), np.nan)
+        high = np.append(_grouped_quantile(values, codes, n_groups, upper), np.nan)
+        result[col] = np.clip(values, low[codes], high[codes])
+    return pd.DataFrame(result, index=data.index)
+
+
+def grouped_mad_clip(data: pd.DataFrame,
+                     columns: Union[str, list],
+                     by: Union[str, list],
+                     n: float = 3.0,
+                     scale: float = 1.4826) -> pd.DataFrame:
+    """
+    Clip each column within each group to median ± n * scale * MAD, where MAD is the median absolute deviation
+    from the median; the default scale makes scale * MAD consistent with the standard deviation of normal data
+    """
+    codes, n_groups = _group_codes(data, by)
+    result = {}
+    for col in _columns(columns):
+        values = data[col].to_numpy(dtype=np.float64)
+        median = np.append(_grouped_quantile(values, codes, n_groups, 0.5), np.nan)
+        mad = np.append(_grouped_quantile(np.abs(values - median[codes]), codes, n_groups, 0.5), np.nan)
+        bound = n * scale * mad[codes]
+        result[col] = np.clip(values, median[codes] - bound, median[codes] + bound)
+    return pd.DataFrame(result, index=data.index)
+
+
+def grouped_neutralize(data: pd.DataFrame,
+                       columns: Union[str, list],
+                       by: Union[str, list],
+                       industry: Union[str, None] = None,
+                       exposures: Union[str, list, None] = None,
+                       add_constant: bool = True) -> pd.DataFrame:
+    """
+    Neutralize each column within each group (e.g. date) by least squares on industry dummies and
+    numeric exposures (e.g. log market cap), returning the residuals.
+    The industry dummies (or the constant) are absorbed by demeaning within the (group, industry) cells,
+    then the demeaned column is regressed on the demeaned exposures with one small k x k system per group
+    (Frisch-Waugh-Lovell), so the dummies are never materialized.
+    Rows with NaN in the column, the exposures or the industry are left out and get NaN.
+
+    :param industry: column of industry labels, one dummy per industry
+    :param exposures: numeric column(s) to neutralize against
+    :param add_constant: include an intercept when industry is not given
+    :return: DataFrame aligned with data with the residuals of the columns
+    """
+    exposures = [] if exposures is None else _columns(exposures)
+    group_by = _columns(by)
+    codes, n_groups = _group_codes(data, group_by)
+    if industry is not None:
+        cells, n_cells = _group_codes(data, group_by + [industry])
+    elif add_constant:
+        cells, n_cells = codes, n_groups
+    else:
+        cells, n_cells = None, 0
+    X = data[exposures].to_numpy(dtype=np.float64).reshape(len(data), len(exposures))
+    k = len(exposures)
+    iu, ju = np.triu_indices(k)
+
+    result = {}
+    for col in _columns(columns):
+        y = data[col].to_numpy(dtype=np.float64)
+        valid = (codes >= 0) & ~np.isnan(y) & ~np.isnan(X).any(axis=1)
+        if cells is not None:
+            valid &= cells >= 0
+        ## demean within the cells, which is the regression on their dummies
+        ## 在单元内去均值，等价于对单元哑变量回归
+        y_tilde = np.where(valid, y, 0.0)
+        X_tilde = np.where(valid[:, None], X, 0.0)
+        if cells is not None:
+            y_tilde = y_tilde - np.append(_grouped_mean(y, cells, valid, n_cells)[0], 0.0)[cells]
+            for i in range(k):
+                X_tilde[:, i] -= np.append(_grouped_mean(X[:, i], cells, valid, n_cells)[0], 0.0)[cells]
+        resid = y_tilde
+        if k:
+            ## one k x k normal equation per group, pseudo-inverse for collinear exposures
+            ## 每组一个k x k正规方程，共线时使用伪逆
+            group = codes[valid]
+            xtx = np.empty((n_groups, k, k))
+            products = X_tilde[valid][:, iu] * X_tilde[valid][:, ju]
+            for m in range(len(iu)):
+                xtx[:, iu[m], ju[m]] = xtx[:, ju[m], iu[m]] = np.bincount(group, weights=products[:, m],
+                                                                          minlength=n_groups)
+            xty = np.column_stack([np.bincount(group, weights=X_tilde[valid][:, i] * y_tilde[valid],
+                                               minlength=n_groups) for i in range(k)])
+            beta = np.einsum('gij,gj->gi', np.linalg.pinv(xtx), xty)
+            resid = y_tilde - np.einsum('ni,ni->n', X_tilde, beta[codes])
+        result[col] = np.where(valid, resid, np.nan)
+    return pd.DataFrame(result, index=data.index)
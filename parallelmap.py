@@ -1,16 +1,27 @@
 from __future__ import annotations
 
-import concurrent.futures
+import asyncio
 import loky
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import warnings
 
 from loky import get_reusable_executor
+from loky.process_executor import BrokenProcessPool
 
 from typing import Union, Callable, Iterable, Sized, Any
 import tqdm
+import cloudpickle
+import contextlib
+import itertools
+import math
 import os
+import shutil
+import signal
+import statistics
+import tempfile
+import threading
+import time
 
 CPU_COUNT = os.cpu_count()
 
@@ -23,7 +34,10 @@ class TaskTimeoutException(Exception):
 
 class TaskTimeoutWarning(Warning):
     "Task timeout Warning"
-    pass
+
+    def __init__(self, message='', idx=None):
+        super().__init__(message)
+        self.idx = idx
 
 def map_thread(func: Callable,
                tasks: Union[Iterable, Sized],
@@ -65,19 +79,529 @@ def map_process_raw(func: Callable,
     return mapped_values
 
 
+## target compute time of one chunk when chunksize='auto'
+## chunksize='auto'时每个任务块的目标计算时间（秒）
+AUTO_CHUNK_SECONDS = 0.2
+
+## seconds a timed out task is given to stop after being interrupted, before its worker process is killed
+## 超时任务被中断后的宽限时间（秒），超过后终止其工作进程
+TIMEOUT_KILL_GRACE = 1.0
+
+
+
+def _percentile(values: list, q: float):
+    ## nearest-rank percentile, None for no values
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class TelemetryStats:
+    """
+    Aggregate statistics of the tasks recorded by a Telemetry, all times in seconds
+    """
+
+    def __init__(self, telemetry: Telemetry, top_k: int = 10):
+        tasks = telemetry.tasks
+        computes = [task['compute'] for task in tasks if task['compute'] is not None]
+        self.n_tasks = len(tasks)
+        self.n_timeouts = sum(task['timed_out'] for task in tasks)
+        self.wall = sum(end - start for start, end, _ in telemetry.runs)
+        self.throughput = self.n_tasks / self.wall if self.wall > 0 else None
+        self.latency_p50 = _percentile(computes, 0.5)
+        self.latency_p99 = _percentile(computes, 0.99)
+        self.wait_p50 = _percentile([task['wait'] for task in tasks if task['wait'] is not None], 0.5)
+        self.wait_p99 = _percentile([task['wait'] for task in tasks if task['wait'] is not None], 0.99)
+        self.transfer_p50 = _percentile([task['transfer'] for task in tasks if task['transfer'] is not None], 0.5)
+        self.bytes_in = sum(task['bytes_in'] or 0 for task in tasks) if telemetry.payload_sizes else None
+        self.bytes_out = sum(task['bytes_out'] or 0 for task in tasks) if telemetry.payload_sizes else None
+
+        ## busy seconds of each worker process, utilization is the busy share of the available worker seconds
+        ## 每个工作进程的忙碌时间，利用率为忙碌时间占可用工作进程时间的比例
+        self.worker_busy = {}
+        for task in tasks:
+            if task['worker'] is not None:
+                self.worker_busy[task['worker']] = self.worker_busy.get(task['worker'], 0.0) + task['compute']
+        capacity = sum((end - start) * max_workers for start, end, max_workers in telemetry.runs)
+        self.utilization = sum(self.worker_busy.values()) / capacity if capacity > 0 else None
+        self.slowest = [(task['index'], task['compute']) for task in
+                        sorted((task for task in tasks if task['compute'] is not None),
+                               key=lambda task: task['compute'], reverse=True)[:top_k]]
+        self.phases = dict(telemetry.phases)
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+    def __repr__(self):
+        def _fmt(value, unit='s'):
+            return 'n/a' if value is None else f'{value:.4g}{unit}'
+        return (f'TelemetryStats({self.n_tasks} tasks, {self.n_timeouts} timeouts, wall {_fmt(self.wall)}, '
+                f'throughput {_fmt(self.throughput, "/s")}, latency p50 {_fmt(self.latency_p50)} '
+                f'p99 {_fmt(self.latency_p99)}, wait p50 {_fmt(self.wait_p50)} p99 {_fmt(self.wait_p99)}, '
+                f'utilization {_fmt(self.utilization, "")}, {len(self.worker_busy)} workers)')
+
+
+class Telemetry:
+    """
+    Opt-in execution telemetry of the loky map functions, passed as telemetry=Telemetry().
+    Each task records its worker process id, the wall clock times when its chunk was submitted,
+    when it started and finished in the worker and when the chunk result arrived in the parent,
+    giving the wait (queue and pickling before the task starts), compute and result transfer times,
+    and optionally the pickled sizes of the task and the result (which costs one more pickling on each side).
+    Timestamps use time.time() so that they are comparable between the processes of one machine.
+    Phases of the callers (e.g. the pd.concat of parallel_groupby_apply) are timed by phase().
+    A telemetry can be reused across several calls, the statistics then cover all of them.
+    """
+
+    def __init__(self, hook: Union[Callable, None] = None, payload_sizes: bool = True, top_k: int = 10):
+        """
+        :param hook: called with the TelemetryStats at the end of every map call, e.g. to export them to a logger
+        :param payload_sizes: if True, record the pickled sizes of tasks and results
+        :param top_k: number of the slowest tasks kept in the statistics
+        """
+        self.hook = hook
+        self.payload_sizes = payload_sizes
+        self.top_k = top_k
+        self.tasks = []
+        self.runs = []
+        self.phases = {}
+        self._futures = {}
+        self._run = None
+
+    def stats(self) -> TelemetryStats:
+        return TelemetryStats(self, top_k=self.top_k)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        ## accumulate the wall time of a named phase
+        ## 累计指定阶段的耗时
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def _start(self, max_workers: int):
+        self._run = (time.time(), max_workers)
+
+    def _finish(self):
+        start, max_workers = self._run
+        self.runs.append((start, time.time(), max_workers))
+        self._futures.clear()
+        if self.hook is not None:
+            self.hook(self.stats())
+
+    def _submitted(self, future):
+        ## the done time is taken in the callback, so the ordered collection does not count as transfer
+        ## 在回调中记录完成时间，使有序收集的等待不计入传输时间
+        done = []
+        future.add_done_callback(lambda _: done.append(time.time()))
+        self._futures[future] = (time.time(), done)
+
+    def _discard(self, future):
+        self._futures.pop(future, None)
+
+    def _collect(self, future, records: list, recovered: list):
+        if future is not None:
+            submitted, done = self._futures.pop(future)
+            received = done[0] if done else time.time()
+            finished = max((record[3] for record in records), default=received)
+            for idx, timed_out, worker, started, ended, bytes_in, bytes_out in records:
+                self.tasks.append({'index': idx, 'timed_out': timed_out, 'worker': worker,
+                                   'submitted': submitted, 'started': started, 'finished': ended,
+                                   'received': received, 'wait': started - submitted, 'compute': ended - started,
+                                   'transfer': received - finished, 'bytes_in': bytes_in, 'bytes_out': bytes_out})
+        ## tasks killed with their worker, or finished in a chunk lost with the pool, have no record from the worker
+        ## 随工作进程一起被终止的任务，以及随进程池失效的任务块中已完成的任务，没有来自工作进程的记录
+        for idx, timed_out, _ in recovered:
+            self.tasks.append({'index': idx, 'timed_out': timed_out, 'worker': None, 'submitted': None, 'started': None,
+                               'finished': None, 'received': None, 'wait': None, 'compute': None,
+                               'transfer': None, 'bytes_in': None, 'bytes_out': None})
+
+
+def phase(telemetry: Union[Telemetry, None], name: str):
+    ## time a phase of the caller if telemetry is enabled
+    ## 启用telemetry时记录调用方某一阶段的耗时
+    return contextlib.nullcontext() if telemetry is None else telemetry.phase(name)
+
+class _Watchdog(threading.Thread):
+    """
+    A single watchdog thread per worker process, watching the task running in the main thread of the worker.
+    When the task exceeds its timeout, it is interrupted by a SIGALRM sent to the main thread (POSIX only).
+    If it is still running TIMEOUT_KILL_GRACE seconds later (e.g. stuck in C code or swallowing the exception),
+    the index of the task is recorded in kill_dir and the worker process is killed, to be recycled by the parent.
+    Arming and disarming only take a lock, so the cost per task is negligible.
+    """
+    _instance = None
+
+    def __init__(self):
+        super().__init__(name='parallelmap-watchdog', daemon=True)
+        self.condition = threading.Condition()
+        self.task = None  ## (index, deadline, kill_dir) of the running task
+        self.idx = None
+        self.in_task = False
+        self.fired = False
+        ## signal handlers can only be installed in the main thread
+        self.interruptible = hasattr(signal, 'pthread_kill') and threading.current_thread() is threading.main_thread()
+        if self.interruptible:
+            signal.signal(signal.SIGALRM, self._interrupt)
+        self.start()
+
+    @classmethod
+    def get(cls) -> _Watchdog:
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def _interrupt(self, signum, frame):
+        ## ignore late signals arriving after the task has finished
+        if self.in_task and self.fired:
+            raise TaskTimeoutException(self.idx)
+
+    def arm(self, idx, timeout: float, kill_dir: Union[str, None]):
+        with self.condition:
+            self.task = (idx, time.monotonic() + timeout, kill_dir)
+            self.idx = idx
+            self.fired = False
+            self.in_task = True
+            self.condition.notify()
+
+    def disarm(self) -> bool:
+        """
+        Stop watching the current task, return whether it has timed out
+        """
+        self.in_task = False
+        with self.condition:
+            self.task = None
+            return self.fired
+
+    def run(self):
+        with self.condition:
+            while True:
+                ## the thread must survive any error, otherwise the tasks of this worker are never killed again
+                ## 监视线程不能因任何错误退出，否则该工作进程的任务将不再被终止
+                try:
+                    self._step()
+                except Exception:
+                    pass
+
+    def _step(self):
+        if self.task is None:
+            self.condition.wait()
+            return
+        idx, deadline, kill_dir = self.task
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            self.condition.wait(remaining)
+        elif not self.fired:
+            ## first interrupt the task, then give it a grace period to stop
+            ## 先中断任务，再给予宽限时间
+            self.fired = True
+            if self.interruptible:
+                self.task = (idx, deadline + TIMEOUT_KILL_GRACE, kill_dir)
+                signal.pthread_kill(threading.main_thread().ident, signal.SIGALRM)
+        elif kill_dir is not None:
+            ## record the killed task so the parent can report it, then kill the worker; the directory is already
+            #   removed if the parent has stopped waiting for the results, the worker is killed anyway
+            ## 记录被终止的任务，然后终止工作进程；若父进程已不再等待结果，目录已被删除，仍然终止工作进程
+            try:
+                open(os.path.join(kill_dir, str(idx)), 'w').close()
+            except OSError:
+                pass
+            os._exit(1)
+        else:
+            self.task = None
+
+
+def _run_task(func: Callable, idx: int, task, timeout, kill_dir, watchdog, profile, results: list, records):
+    ## run one task of a chunk under the watchdog, append its result and telemetry record
+    ## 在监视线程下运行任务块中的一个任务，记录结果和遥测数据
+    started = time.time()
+    result = None
+    timed_out = False
+    if watchdog is None:
+        result = func(task)
+    else:
+        try:
+            watchdog.arm(idx, timeout, kill_dir)
+            try:
+                result = func(task)
+            finally:
+                timed_out = watchdog.disarm()
+        except TaskTimeoutException:
+            timed_out = watchdog.disarm() or True
+        if timed_out:
+            result = None
+    results.append((idx, timed_out, result))
+    if records is not None:
+        records.append((idx, timed_out, os.getpid(), started, time.time(),
+                        len(cloudpickle.dumps(task)) if profile else None,
+                        len(cloudpickle.dumps(result)) if profile else None))
+
+
+def _run_chunk(func: Callable,
+               chunk: list,
+               timeout: Union[float, None] = None,
+               kill_dir: Union[str, None] = None,
+               profile: Union[bool, None] = None):
+    """
+    Run a chunk of tasks in the worker, each task with its own timeout watched by the watchdog of the worker.
+    :param chunk: a list of (index, task)
+    :param kill_dir: directory where the watchdog records the index of a task before killing the worker,
+        the finished tasks of a chunk are also saved there until the chunk returns, see _recover_chunk
+    :param profile: None to skip telemetry, False to record times, True to also record the pickled payload sizes
+    :return: (compute seconds, a list of (index, timed out, result),
+        None or a list of (index, timed out, pid, start time, end time, task bytes, result bytes))
+    """
+    start = time.perf_counter()
+    results = []
+    records = None if profile is None else []
+    watchdog = None if timeout is None else _Watchdog.get()
+    ## a killed worker breaks the whole pool, the results saved here are not computed again
+    ## 终止工作进程会使整个进程池失效，此处保存的结果不会被重新计算
+    save = kill_dir is not None and len(chunk) > 1
+    try:
+        for idx, task in chunk:
+            _run_task(func, idx, task, timeout, kill_dir, watchdog, profile, results, records)
+            if save:
+                _save_result(kill_dir, results[-1])
+    finally:
+        if save:
+            for idx, _, _ in results:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(kill_dir, f'{idx}.done'))
+    return time.perf_counter() - start, results, records
+
+
+def _save_result(kill_dir: str, item: tuple):
+    ## written atomically, a worker killed while writing leaves no partial file
+    ## 原子写入，写入时被终止的工作进程不会留下不完整的文件
+    path = os.path.join(kill_dir, f'{item[0]}.done')
+    with open(f'{path}.{os.getpid()}.tmp', 'wb') as f:
+        cloudpickle.dump(item, f)
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+
+def _killed_tasks(kill_dir: Union[str, None]) -> set:
+    ## indices of the tasks recorded by the watchdogs before killing their workers
+    ## 监视线程终止工作进程前记录的任务序号
+    return set() if kill_dir is None else {int(name) for name in os.listdir(kill_dir) if name.isdigit()}
+
+
+def _recover_chunk(chunk: list, kill_dir: str, killed: set):
+    """
+    Split a chunk lost with a broken pool into the tasks to resubmit and the results already known:
+    the killed tasks are timed out, and the tasks finished before the pool broke keep their saved results
+    :return: (remaining chunk, a list of (index, timed out, result))
+    """
+    remaining, results = [], []
+    for idx, task in chunk:
+        path = os.path.join(kill_dir, f'{idx}.done')
+        if idx in killed:
+            results.append((idx, True, None))
+        elif os.path.exists(path):
+            with open(path, 'rb') as f:
+                results.append(cloudpickle.load(f))
+            os.remove(path)
+        else:
+            remaining.append((idx, task))
+    return remaining, results
+
+
+def _auto_chunksize(task_seconds: float, n_remaining: Union[int, None], max_workers: int):
+    """
+    Choose a chunk size so that one chunk takes about AUTO_CHUNK_SECONDS,
+    while keeping at least 4 chunks per worker for load balancing when the number of remaining tasks is known
+    """
+    chunksize = int(AUTO_CHUNK_SECONDS / task_seconds) if task_seconds > 0 else (n_remaining or 1)
+    if n_remaining is not None:
+        chunksize = min(chunksize, math.ceil(n_remaining / (max_workers * 4)))
+    return max(1, chunksize)
+
+
+def _run_chunks(func: Callable,
+                tasks: Iterable,
+                max_workers: int = CPU_COUNT,
+                chunksize: Union[int, str, None] = None,
+                timeout: Union[float, None] = None,
+                ordered: bool = True,
+                max_inflight: Union[int, None] = None,
+                telemetry: Union[Telemetry, None] = None,
+                executor_kwargs: dict = {}):
+    """
+    Run the tasks in chunks on the reusable loky executor. The tasks are consumed lazily,
+    keeping at most max_inflight tasks submitted but not yet yielded (at least one chunk).
+    With chunksize='auto', the first task of each worker is submitted alone to measure the cost per task,
+    and the chunk size of the remaining tasks is chosen as soon as one of them finishes.
+    Workers killed by the timeout watchdog are recycled: the killed tasks are reported as timed out,
+    and the other unfinished chunks are resubmitted to a new executor.
+    :param ordered: if True, yield in submission order, else in completion order of the chunks
+    :param max_inflight: maximum number of tasks submitted but not yet yielded, unlimited if None;
+        in ordered mode it also bounds the number of finished results buffered for reordering
+    :param telemetry: if given, the tasks are recorded in it
+    :param executor_kwargs: key arguments for loky multiprocessing executor, kept apart from the parameters above
+        so that e.g. the idle worker timeout of loky is never taken for the per-task timeout
+    :return: a generator of (number of tasks, a list of (index, timed out, result) sorted by index) per chunk
+    """
+    n_tasks = len(tasks) if hasattr(tasks, '__len__') else None
+    items = enumerate(tasks)
+    kill_dir = None if timeout is None else tempfile.mkdtemp(prefix='parallelmap-')
+    killed = set()
+    ## [chunk, future, number of tasks, results recovered from lost chunks]
+    pending = []
+    profile = None if telemetry is None else telemetry.payload_sizes
+    executor = get_reusable_executor(max_workers=max_workers, **executor_kwargs)
+
+    def _submit_chunk(chunk):
+        future = executor.submit(_run_chunk, func, chunk, timeout, kill_dir, profile)
+        if telemetry is not None:
+            telemetry._submitted(future)
+        return future
+
+    def _submit(size):
+        chunk = list(itertools.islice(items, size))
+        if chunk:
+            pending.append([chunk, _submit_chunk(chunk), len(chunk), []])
+        return len(chunk)
+
+    if telemetry is not None:
+        telemetry._start(max_workers)
+    try:
+        exhausted = False
+        inflight = 0
+        if chunksize == 'auto':
+            n_probes = max_workers if max_inflight is None else max(1, min(max_workers, max_inflight))
+            inflight = sum(_submit(1) for _ in range(n_probes))
+            exhausted = inflight < n_probes
+            chunksize = 1
+            if not exhausted:
+                done, _ = loky.wait([entry[1] for entry in pending], return_when=loky.FIRST_COMPLETED)
+                seconds = [future.result()[0] for future in done if future.exception() is None]
+                chunksize = _auto_chunksize(statistics.median(seconds) if seconds else 0.0,
+                                            None if n_tasks is None else n_tasks - len(pending), max_workers)
+                if max_inflight is not None:
+                    chunksize = min(chunksize, max(1, max_inflight // max_workers))
+        chunksize = max(1, int(chunksize or 1))
+
+        while True:
+            ## keep the number of in-flight tasks under max_inflight
+            ## 保持已提交未返回的任务数不超过max_inflight
+            while not exhausted and (max_inflight is None or not pending
+                                     or inflight + chunksize <= max_inflight):
+                submitted = _submit(chunksize)
+                inflight += submitted
+                exhausted = submitted < chunksize
+            if not pending:
+                break
+
+            entry = pending[0]
+            if not ordered and entry[1] is not None:
+                done, _ = loky.wait([entry[1] for entry in pending if entry[1] is not None],
+                                    return_when=loky.FIRST_COMPLETED)
+                entry = next(entry for entry in pending if entry[1] is None or entry[1] in done)
+            try:
+                _, results, records = (None, [], None) if entry[1] is None else entry[1].result()
+            except BrokenProcessPool:
+                newly_killed = _killed_tasks(kill_dir) - killed
+                if not newly_killed:
+                    raise
+                killed |= newly_killed
+                ## the whole pool is broken with the killed worker, resubmit the unfinished tasks of the lost chunks,
+                #   the killed tasks are timed out and the tasks finished before the pool broke keep their results
+                ## 终止工作进程会使整个进程池失效，重新提交失效任务块中未完成的任务，被终止的任务视为超时，已完成的任务保留结果
+                loky.wait([entry[1] for entry in pending if entry[1] is not None])
+                executor = get_reusable_executor(max_workers=max_workers, **executor_kwargs)
+                for entry in pending:
+                    if entry[1] is None or entry[1].exception() is None:
+                        continue
+                    entry[0], recovered = _recover_chunk(entry[0], kill_dir, killed)
+                    entry[3] += recovered
+                    if telemetry is not None:
+                        telemetry._discard(entry[1])
+                    entry[1] = _submit_chunk(entry[0]) if entry[0] else None
+                continue
+            pending.remove(entry)
+            inflight -= entry[2]
+            if telemetry is not None:
+                telemetry._collect(entry[1], records or [], entry[3])
+            yield entry[2], sorted(results + entry[3], key=lambda x: x[0])
+    finally:
+        ## cancel the chunks not started yet if the consumer stops early
+        ## 若调用方提前停止迭代，取消尚未开始的任务块
+        running = [entry[1] for entry in pending if entry[1] is not None and not entry[1].cancel()]
+        if kill_dir is not None:
+            ## wait for the running chunks, bounded by the watchdog, so that a worker killed for a timeout is killed
+            #   while this call still owns the pool, instead of breaking the pool under the next caller
+            ## 等待正在运行的任务块（由监视线程限时），使超时的工作进程在本次调用内被终止，而不是破坏下一次调用的进程池
+            loky.wait(running)
+            shutil.rmtree(kill_dir, ignore_errors=True)
+        if telemetry is not None:
+            telemetry._finish()
+
+
+def _remove_when_done(futures: list, path: str):
+    ## remove the directory once all the futures are done
+    ## 所有future结束后删除目录
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def _done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            shutil.rmtree(path, ignore_errors=True)
+
+    for future in futures:
+        future.add_done_callback(_done)
+
+
+def _collect_chunks(chunks: Iterable,
+                    total: Union[int, None] = None,
+                    progress_bar: bool = True,
+                    timeout_replacer: Any = None,
+                    timeouts: Union[list, None] = None):
+    """
+    Collect the results of the chunks item by item, replace the result of timed out tasks by timeout_replacer.
+    The progress bar is updated per item.
+    :param chunks: chunks of results from _run_chunks
+    :param total: total number of tasks for the progress bar
+    :param timeouts: if given, the indices of timed out tasks are appended to it
+    :return: a generator of (index, result)
+    """
+    with tqdm.tqdm(total=total, disable=not progress_bar) as bar:
+        for size, results in chunks:
+            for idx, timed_out, result in results:
+                if timed_out:
+                    message = f"future {idx} aborted due to timeout"
+                    warnings.warn(TaskTimeoutWarning(message, idx))
+                    if timeouts is not None:
+                        timeouts.append(idx)
+                    result = timeout_replacer
+                yield idx, result
+            bar.update(size)
+
+
 def map_loky_raw(func: Callable,
                  tasks: Union[Iterable, Sized],
                  max_workers: int = CPU_COUNT,
                  progress_bar: bool = True,
+                 chunksize: Union[int, str, None] = None,
+                 telemetry: Union[Telemetry, None] = None,
                  **kwargs):
     """
     use the map function of joblib/loky, with robust multiprocessing and jupyter support
+
+    :param chunksize: number of tasks sent to a worker at once, 'auto' to choose it by measuring the cost per task
+    :param telemetry: a Telemetry recording the execution of every task, see Telemetry
+    :param kwargs: key arguments for loky multiprocessing executor, e.g. timeout is the idle timeout of the workers,
+        not a per-task timeout (see map_loky)
     """
-    with get_reusable_executor(max_workers=max_workers, **kwargs) as executor:
-        if progress_bar and hasattr(tasks, '__len__'):
-            mapped_values = list(tqdm.tqdm(executor.map(func, tasks), total=len(tasks)))
-        else:
-            mapped_values = executor.map(func, tasks)
+    tasks = list(tasks)
+    chunks = _run_chunks(func, tasks, max_workers=max_workers, chunksize=chunksize, telemetry=telemetry,
+                         executor_kwargs=kwargs)
+    mapped_values = [result for _, result in _collect_chunks(chunks, len(tasks), progress_bar=progress_bar)]
     return mapped_values
 
 
@@ -87,54 +611,43 @@ def map_loky(func: Callable,
              progress_bar: bool = True,
              timeout: Union[float, None] = None,
              timeout_replacer: Any = None,
+             chunksize: Union[int, str, None] = None,
+             return_timeouts: bool = False,
+             telemetry: Union[Telemetry, None] = None,
              **kwargs):
     """
     Based on map_loky_raw, adding task-wise timeout support.
     If the executing time of single task exceeds timeout, then the task will be aborted
         and the result will be replaced by timeout_replacer (defult None)
+    Timed out tasks are interrupted by a watchdog in the worker, and the worker process is killed and recycled
+        if the task does not stop within TIMEOUT_KILL_GRACE seconds.
+    Killing a worker breaks the whole reusable executor: the tasks of this call running in the other workers at that
+        moment are run again (the tasks finished earlier keep their results), so func must be idempotent with a
+        timeout, and other callers sharing the executor at the same time get BrokenProcessPool.
 
     :param timeout: timeout value for each task
     :param timeout_replacer: if a task times out, then the result of this task will be replaced by timeout_replacer
+    :param chunksize: number of tasks sent to a worker at once, 'auto' to choose it by measuring the cost per task,
+        the timeout still applies to every single task
+    :param return_timeouts: if True, also return the indices of timed out tasks
+    :param telemetry: a Telemetry recording the execution of every task, see Telemetry
     :param kwargs: key arguments for loky multiprocessing executor
-    :return: a list of results
+    :return: a list of results, and the list of timed out indices if return_timeouts
     """
-
-    def _abortable_task(item):
-        """
-        Run the real task in a sub thread with the main thread counting time and
-        aborting the timed out task by raising TimeoutError.
-        :param item: item[0] is the index of task, item[1] is the arg of the task
-        :return:
-        """
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(func, item[1])
-            try:
-                res = future.result(timeout=timeout)
-                return res
-            except concurrent.futures.TimeoutError:
-                message=f"future {item[0]} aborted due to timeout"
-                warnings.warn(message,TaskTimeoutWarning)
-                raise TaskTimeoutException
-
-    def _collect_result(future):
-        """
-        Collect the result of the future, replace the result of timed out tasks by {replacer} arg
-        :param future:
-        :return:
-        """
-        try:
-            return future.result()
-        except TaskTimeoutException:
-            return timeout_replacer
-
-    with get_reusable_executor(max_workers=max_workers, **kwargs) as executor:
-        futures = list(executor.submit(_abortable_task, (idx, task)) for idx, task in enumerate(tasks))
-        if progress_bar:
-            results = list(tqdm.tqdm(map(_collect_result, futures), total=len(futures)))
-        else:
-            results = list(map(_collect_result, executor.map(_abortable_task, tasks)))
+    tasks = list(tasks)
+    timeouts = []
+    chunks = _run_chunks(func, tasks, max_workers=max_workers, chunksize=chunksize, timeout=timeout,
+                         telemetry=telemetry, executor_kwargs=kwargs)
+    results = [result for _, result in _collect_chunks(chunks,
+                                                      len(tasks),
+                                                      progress_bar=progress_bar,
+                                                      timeout_replacer=timeout_replacer,
+                                                      timeouts=timeouts)]
+    if return_timeouts:
+        return results, sorted(timeouts)
     return results
 
+
 def imap_loky(func: Callable,
               tasks: Iterable,
               max_workers: int = CPU_COUNT,
@@ -143,59 +656,324 @@ def imap_loky(func: Callable,
               timeout_replacer: Any = None,
               sorted=True,
               index=False,
+              chunksize: Union[int, str, None] = None,
+              return_timeouts: bool = False,
+              telemetry: Union[Telemetry, None] = None,
               **kwargs):
     """
     Based on imap instead map, also added timeout support.
     Can choose whether to sort the results by index, and whether to return the index of the result.
+    A timed out task that does not stop kills its worker, the tasks running at that moment are run again and func
+        must be idempotent, see map_loky.
     :param timeout: timeout value for each task
     :param timeout_replacer: if a task times out, then the result of this task will be replaced by timeout_replacer
+    :param chunksize: number of tasks sent to a worker at once, 'auto' to choose it by measuring the cost per task
+    :param return_timeouts: if True, also return the indices of timed out tasks (as the last returned value)
+    :param telemetry: a Telemetry recording the execution of every task, see Telemetry
     :param kwargs: key arguments for executor
     :return:
     """
-
-    def _abortable_task(item):
-        """
-        Run the real processing function in a sub thread so the main thread can
-        abort timed out task by raising TimeoutError.
-        :param item: item[0] is the index, item[1] is the arg of the task
-        :return:
-        """
-        idx = item[0]
-        task = item[1]
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(func, task)
-            try:
-                res = future.result(timeout=timeout)
-                return idx, res
-            except concurrent.futures.TimeoutError:
-                message = f"future {item[0]} aborted due to timeout"
-                warnings.warn(message,TaskTimeoutWarning)
-                ## pass the index of task when raise error so that we can find the correct position in results
-                raise TaskTimeoutException(idx)
-
-    def _collect_result(future):
-        """
-        Collect the result of the future, replace the result of timed out tasks by %replacer% arg.
-        :param future:
-        :return:
-        """
-        try:
-            return future.result()
-        except TaskTimeoutException as e:
-            return e.idx, timeout_replacer
-
-    with get_reusable_executor(max_workers=max_workers, **kwargs) as executor:
-        futures = list(executor.submit(_abortable_task, (idx, task)) for idx, task in enumerate(tasks))
-        if progress_bar:
-            results = list(tqdm.tqdm(map(_collect_result, loky.as_completed(futures)), total=len(futures)))
-        else:
-            results = list(map(_collect_result, executor.map(_abortable_task, loky.as_completed(futures))))
+    tasks = list(tasks)
+    timeouts = []
+    chunks = _run_chunks(func, tasks, max_workers=max_workers, chunksize=chunksize, timeout=timeout,
+                         ordered=False, telemetry=telemetry, executor_kwargs=kwargs)
+    results = list(_collect_chunks(chunks,
+                                   len(tasks),
+                                   progress_bar=progress_bar,
+                                   timeout_replacer=timeout_replacer,
+                                   timeouts=timeouts))
     if sorted:
         results.sort(key=lambda x: x[0])    ## sort by task index
     if index:
-        return [x[0] for x in results], [x[1] for x in results]
+        output = [x[0] for x in results], [x[1] for x in results]
     else:
-        return [x[1] for x in results]
+        output = [x[1] for x in results],
+    if return_timeouts:
+        timeouts.sort()
+        output += (timeouts,)
+    return output if len(output) > 1 else output[0]
+
+def stream_loky(func: Callable,
+                tasks: Iterable,
+                max_workers: int = CPU_COUNT,
+                max_inflight: Union[int, None] = None,
+                ordered: bool = True,
+                progress_bar: bool = True,
+                timeout: Union[float, None] = None,
+                timeout_replacer: Any = None,
+                index: bool = False,
+                chunksize: Union[int, str, None] = None,
+                telemetry: Union[Telemetry, None] = None,
+                **kwargs):
+    """
+    A true generator version of imap_loky: tasks are consumed lazily (unbounded or generated inputs are accepted)
+    and results are yielded as soon as they are available, with a bounded number of in-flight tasks,
+    so loading, computing and writing can be pipelined without holding everything in memory.
+
+    :param max_inflight: maximum number of tasks submitted but not yet yielded, 4 per worker by default
+    :param ordered: if True, yield results in task order with a reorder buffer bounded by max_inflight,
+        else yield them in completion order
+    :param timeout: timeout value for each task
+    :param timeout_replacer: if a task times out, then the result of this task will be replaced by timeout_replacer
+    :param index: if True, yield (index, result) instead of result
+    :param chunksize: number of tasks sent to a worker at once, 'auto' to choose it by measuring the cost per task
+    :param telemetry: a Telemetry recording the execution of every task, see Telemetry
+    :param kwargs: key arguments for loky multiprocessing executor
+    :return: a generator of results
+    """
+    if max_inflight is None:
+        max_inflight = max_workers * 4
+    total = len(tasks) if hasattr(tasks, '__len__') else None
+    chunks = _run_chunks(func, tasks, max_workers=max_workers, chunksize=chunksize, timeout=timeout,
+                         ordered=ordered, max_inflight=max_inflight, telemetry=telemetry, executor_kwargs=kwargs)
+    for idx, result in _collect_chunks(chunks, total, progress_bar=progress_bar, timeout_replacer=timeout_replacer):
+        yield (idx, result) if index else result
+
+
+async def _take(iterator, start: int, size: int) -> list:
+    ## the next size tasks of a sync or async iterator, as (index, task)
+    ## 从同步或异步迭代器中取出接下来的size个任务，形式为(序号, 任务)
+    if hasattr(iterator, '__anext__'):
+        chunk = []
+        while len(chunk) < size:
+            try:
+                chunk.append(await iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    else:
+        chunk = list(itertools.islice(iterator, size))
+    return list(enumerate(chunk, start))
+
+
+async def _arun_chunks(func: Callable,
+                       tasks: Iterable,
+                       max_workers: int = CPU_COUNT,
+                       chunksize: int = 1,
+                       timeout: Union[float, None] = None,
+                       ordered: bool = False,
+                       max_concurrency: Union[int, None] = None,
+                       kill_on_cancel: bool = True,
+                       telemetry: Union[Telemetry, None] = None,
+                       executor_kwargs: dict = {}):
+    """
+    Asyncio counterpart of _run_chunks on the same reusable loky executor: the loky futures are awaited through
+    asyncio.wrap_future, so the event loop keeps running while the tasks are computed. Tasks (a sync or async
+    iterable) are consumed lazily, keeping at most max_concurrency tasks submitted but not yet yielded.
+    Timeouts are handled by the watchdog of the workers and killed workers are recycled as in _run_chunks.
+    If the awaiting task is cancelled, the chunks not started yet are cancelled, and since loky cannot cancel
+    a running task, the workers of the executor are killed when kill_on_cancel (a new executor is created on next use).
+    :return: an async generator of (number of tasks, a list of (index, timed out, result) sorted by index) per chunk
+    """
+    iterator = tasks.__aiter__() if hasattr(tasks, '__aiter__') else iter(tasks)
+    chunksize = max(1, int(chunksize))
+    limit = max(chunksize, max_concurrency or max_workers * 4)
+    kill_dir = None if timeout is None else tempfile.mkdtemp(prefix='parallelmap-')
+    killed = set()
+    ## [chunk, loky future, asyncio future, number of tasks, results recovered from lost chunks]
+    pending = []
+    profile = None if telemetry is None else telemetry.payload_sizes
+    executor = get_reusable_executor(max_workers=max_workers, **executor_kwargs)
+
+    def _submit(chunk):
+        future = executor.submit(_run_chunk, func, chunk, timeout, kill_dir, profile)
+        if telemetry is not None:
+            telemetry._submitted(future)
+        return future, asyncio.wrap_future(future)
+
+    if telemetry is not None:
+        telemetry._start(max_workers)
+    cancelled = False
+    try:
+        n_submitted = 0
+        inflight = 0
+        exhausted = False
+        while True:
+            while not exhausted and inflight + chunksize <= limit:
+                chunk = await _take(iterator, n_submitted, chunksize)
+                n_submitted += len(chunk)
+                inflight += len(chunk)
+                exhausted = len(chunk) < chunksize
+                if chunk:
+                    pending.append([chunk, *_submit(chunk), len(chunk), []])
+            if not pending:
+                break
+
+            candidates = pending[:1] if ordered else pending
+            waiting = [entry[2] for entry in candidates if entry[2] is not None]
+            if waiting:
+                await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if any(entry[2] is not None and entry[2].done() and isinstance(entry[2].exception(), BrokenProcessPool)
+                   for entry in pending):
+                newly_killed = _killed_tasks(kill_dir) - killed
+                if not newly_killed:
+                    raise next(entry[2].exception() for entry in pending
+                               if entry[2] is not None and entry[2].done() and entry[2].exception() is not None)
+                killed |= newly_killed
+                ## the whole pool is broken with the killed worker, resubmit the unfinished tasks of the lost chunks,
+                #   the killed tasks are timed out and the tasks finished before the pool broke keep their results
+                ## 终止工作进程会使整个进程池失效，重新提交失效任务块中未完成的任务，被终止的任务视为超时，已完成的任务保留结果
+                await asyncio.wait([entry[2] for entry in pending if entry[2] is not None])
+                executor = get_reusable_executor(max_workers=max_workers, **executor_kwargs)
+                for entry in pending:
+                    if entry[2] is None or entry[2].exception() is None:
+                        continue
+                    entry[0], recovered = _recover_chunk(entry[0], kill_dir, killed)
+                    entry[4] += recovered
+                    if telemetry is not None:
+                        telemetry._discard(entry[1])
+                    entry[1], entry[2] = _submit(entry[0]) if entry[0] else (None, None)
+                continue
+
+            for entry in [entry for entry in candidates if entry[2] is None or entry[2].done()]:
+                _, results, records = (None, [], None) if entry[2] is None else entry[2].result()
+                pending.remove(entry)
+                inflight -= entry[3]
+                if telemetry is not None:
+                    telemetry._collect(entry[1], records or [], entry[4])
+                yield entry[3], sorted(results + entry[4], key=lambda x: x[0])
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        ## cancel the chunks not started yet, and kill the workers running the others if the awaiting task is cancelled
+        ## 取消尚未开始的任务块；若等待方被取消，则终止正在运行任务的工作进程
+        running = []
+        for entry in pending:
+            if entry[1] is not None and not entry[1].cancel() and not entry[1].done():
+                running.append(entry[1])
+            if entry[2] is not None:
+                ## the wrapper no longer receives the result, so the error of a killed task is never reported
+                ## 包装的asyncio future不再接收结果，被终止任务的错误不会被报告
+                entry[2].cancel()
+        if cancelled and running and kill_on_cancel:
+            executor.shutdown(wait=False, kill_workers=True)
+        elif kill_dir is not None and running:
+            if cancelled:
+                ## the cancellation is not delayed, the watchdog may still record a timed out task in kill_dir
+                ## 不延迟取消，监视线程仍可能在kill_dir中记录超时任务
+                _remove_when_done(running, kill_dir)
+                kill_dir = None
+            else:
+                ## as in _run_chunks, a worker killed for a timeout is killed while this call still owns the pool
+                ## 与_run_chunks相同，超时的工作进程在本次调用内被终止
+                done, _ = await asyncio.wait([asyncio.wrap_future(future) for future in running])
+                for future in done:
+                    future.exception()
+        if kill_dir is not None:
+            shutil.rmtree(kill_dir, ignore_errors=True)
+        if telemetry is not None:
+            telemetry._finish()
+
+
+async def _acollect_chunks(chunks,
+                           total: Union[int, None] = None,
+                           progress_bar: bool = False,
+                           timeout_replacer: Any = None,
+                           timeouts: Union[list, None] = None):
+    """
+    Async counterpart of _collect_chunks
+    :return: an async generator of (index, result)
+    """
+    try:
+        with tqdm.tqdm(total=total, disable=not progress_bar) as bar:
+            async for size, results in chunks:
+                for idx, timed_out, result in results:
+                    if timed_out:
+                        message = f"future {idx} aborted due to timeout"
+                        warnings.warn(TaskTimeoutWarning(message, idx))
+                        if timeouts is not None:
+                            timeouts.append(idx)
+                        result = timeout_replacer
+                    yield idx, result
+                bar.update(size)
+    finally:
+        await chunks.aclose()
+
+
+async def amap_loky(func: Callable,
+                    tasks: Iterable,
+                    max_workers: int = CPU_COUNT,
+                    max_concurrency: Union[int, None] = None,
+                    progress_bar: bool = False,
+                    timeout: Union[float, None] = None,
+                    timeout_replacer: Any = None,
+                    chunksize: int = 1,
+                    return_timeouts: bool = False,
+                    kill_on_cancel: bool = True,
+                    telemetry: Union[Telemetry, None] = None,
+                    **kwargs):
+    """
+    Awaitable version of map_loky for asyncio applications: the tasks run on the same reusable loky executor
+    while the event loop keeps serving other coroutines.
+
+    :param tasks: an iterable or an async iterable of tasks, consumed lazily
+    :param max_concurrency: maximum number of tasks submitted but not yet finished, 4 per worker by default
+    :param timeout: timeout value for each task, watched in the workers as in map_loky
+    :param timeout_replacer: if a task times out, then the result of this task will be replaced by timeout_replacer
+    :param chunksize: number of tasks sent to a worker at once
+    :param return_timeouts: if True, also return the indices of timed out tasks
+    :param kill_on_cancel: if True and the awaiting task is cancelled, the workers still running its tasks are killed
+        (loky cannot cancel running tasks), which also aborts the running tasks of other callers of the executor
+    :param telemetry: a Telemetry recording the execution of every task, see Telemetry
+    :param kwargs: key arguments for loky multiprocessing executor
+    :return: a list of results, and the list of timed out indices if return_timeouts
+    """
+    total = None if hasattr(tasks, '__aiter__') or not hasattr(tasks, '__len__') else len(tasks)
+    timeouts = []
+    chunks = _arun_chunks(func, tasks, max_workers=max_workers, chunksize=chunksize, timeout=timeout,
+                          max_concurrency=max_concurrency, kill_on_cancel=kill_on_cancel, telemetry=telemetry,
+                          executor_kwargs=kwargs)
+    results = {}
+    async for idx, result in _acollect_chunks(chunks, total, progress_bar=progress_bar,
+                                              timeout_replacer=timeout_replacer, timeouts=timeouts):
+        results[idx] = result
+    results = [results[idx] for idx in range(len(results))]
+    if return_timeouts:
+        return results, sorted(timeouts)
+    return results
+
+
+async def aimap_loky(func: Callable,
+                     tasks: Iterable,
+                     max_workers: int = CPU_COUNT,
+                     max_concurrency: Union[int, None] = None,
+                     ordered: bool = False,
+                     progress_bar: bool = False,
+                     timeout: Union[float, None] = None,
+                     timeout_replacer: Any = None,
+                     index: bool = False,
+                     chunksize: int = 1,
+                     kill_on_cancel: bool = True,
+                     telemetry: Union[Telemetry, None] = None,
+                     **kwargs):
+    """
+    Async iterator version of stream_loky: results are yielded as soon as they finish (or in task order if ordered),
+    so fetching the inputs, computing and publishing the results can overlap in one event loop.
+    Use it as "async for result in aimap_loky(func, tasks)".
+
+    :param tasks: an iterable or an async iterable of tasks, consumed lazily
+    :param max_concurrency: maximum number of tasks submitted but not yet yielded, 4 per worker by default
+    :param ordered: if True, yield results in task order, else in completion order
+    :param timeout: timeout value for each task, watched in the workers as in map_loky
+    :param timeout_replacer: if a task times out, then the result of this task will be replaced by timeout_replacer
+    :param index: if True, yield (index, result) instead of result
+    :param chunksize: number of tasks sent to a worker at once
+    :param kill_on_cancel: if True and the consuming task is cancelled, the workers still running its tasks are killed
+    :param telemetry: a Telemetry recording the execution of every task, see Telemetry
+    :param kwargs: key arguments for loky multiprocessing executor
+    :return: an async generator of results
+    """
+    total = None if hasattr(tasks, '__aiter__') or not hasattr(tasks, '__len__') else len(tasks)
+    chunks = _arun_chunks(func, tasks, max_workers=max_workers, chunksize=chunksize, timeout=timeout, ordered=ordered,
+                          max_concurrency=max_concurrency, kill_on_cancel=kill_on_cancel, telemetry=telemetry,
+                          executor_kwargs=kwargs)
+    results = _acollect_chunks(chunks, total, progress_bar=progress_bar, timeout_replacer=timeout_replacer)
+    try:
+        async for idx, result in results:
+            yield (idx, result) if index else result
+    finally:
+        await results.aclose()
+
 
 def starmap_loky(func: Callable,
                  tasks: Union[Iterable,Sized],
@@ -203,6 +981,7 @@ def starmap_loky(func: Callable,
                  progress_bar: bool = True,
                  timeout: Union[float, None] = None,
                  timeout_replacer: Any = None,
+                 chunksize: Union[int, str, None] = None,
                  **kwargs):
     """
     Based on map_loky, acts like starmap in itertools
@@ -216,6 +995,7 @@ def starmap_loky(func: Callable,
                     progress_bar=progress_bar,
                     timeout=timeout,
                     timeout_replacer=timeout_replacer,
+                    chunksize=chunksize,
                     **kwargs)
 
 
@@ -227,6 +1007,7 @@ def istarmap_loky(func: Callable,
                   timeout_replacer: Any = None,
                   sorted=True,
                   index=False,
+                  chunksize: Union[int, str, None] = None,
                   **kwargs):
     """
     Like starmap_loky, but is based on imap instead of map
@@ -242,4 +1023,5 @@ def istarmap_loky(func: Callable,
                     timeout_replacer=timeout_replacer,
                     sorted=sorted,
                     index=index,
+                    chunksize=chunksize,
                     **kwargs)
@@ -0,0 +1,130 @@
+from __future__ import annotations
+from typing import Union
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import calutils
+
+## column added to the point-in-time table, the first trading day a filing can be used
+## 时点表中增加的列，财务报告可被使用的第一个交易日
+EFFECTIVE_COL = 'effective_date'
+
+
+def pit_table(reports: pd.DataFrame,
+              symbol_col: str = 'symbol',
+              announce_col: str = 'ann_date',
+              period_col: str = 'period',
+              calendar_path: str = 'SSE',
+              lag: int = 0) -> pd.DataFrame:
+    """
+    Point-in-time table of financial report filings: every filing becomes effective on a trading day of the calendar,
+    and only the filings that change the latest known report of their symbol are kept, i.e. a new report period or a
+    restatement of the latest period. Restatements of older periods announced after a newer period are dropped,
+    since the latest period stays the one known as of these dates.
+
+    :param reports: filings, one row per (symbol, announcement date, report period), restatements as additional rows
+    :param announce_col: announcement date of the filing
+    :param period_col: report period (dates or sortable labels such as "2020Q1"), later periods sort after earlier ones
+    :param calendar_path: exchange name of a bundled calendar ("SSE", "SZSE", "HKEX", "NYEX", "NASDAQ")
+        or path to a calendar csv file
+    :param lag: a filing is effective lag trading days after its announcement, lag=0 rolls forward to the
+        announcement day itself if it is a trading day, lag=1 to the next trading day (announced after the close)
+        the filings with no effective day in the calendar (e.g. announced after its last day) are dropped with a warning
+    :return: the effective filings sorted by symbol and effective date, with the column "effective_date"
+    """
+    calendar = calutils.get_calendar(calendar_path)
+    effective = calendar.offset(reports[announce_col].to_numpy(), lag).view(np.int64)
+    codes, _ = pd.factorize(reports[symbol_col], sort=True)
+    periods, _ = pd.factorize(reports[period_col], sort=True)
+    announce = reports[announce_col].to_numpy(dtype='datetime64[ns]')
+
+    ## filings effective after the end of the calendar cannot be placed, e.g. an outdated bundled calendar
+    ## 生效日晚于交易日历最后一天的公告无法确定生效日，例如内置交易日历未更新
+    beyond = (effective == calutils.TradingCalendar.NAT) & ~np.isnat(announce)
+    if beyond.any():
+        warnings.warn(f'{beyond.sum()} filings announced up to {announce[beyond].max().astype("datetime64[D]")} '
+                      f'are not effective within the calendar {calendar!r} and are dropped', stacklevel=2)
+
+    ## order the filings by symbol, effective day, announcement and period, the original order breaks the remaining ties
+    ## 按股票代码、生效日、公告日和报告期排序，其余相同时保持原有顺序
+    rows = np.flatnonzero((codes >= 0) & (periods >= 0) & (effective != calutils.TradingCalendar.NAT))
+    order = rows[np.lexsort((periods[rows], announce[rows], effective[rows], codes[rows]))]
+
+    ## a filing is kept if its period is not earlier than any period of the same symbol effective before it,
+    #   the running maximum of (symbol, period) in one key resets at each symbol since the symbols are sorted
+    ## 报告期不早于该股票此前所有已生效报告期的公告保留；(股票, 报告期)合并为一个键，股票有序，累计最大值在每只股票处重置
+    key = codes[order].astype(np.int64) * (periods.max(initial=0) + 1) + periods[order]
+    order = order[key == np.maximum.accumulate(key)] if len(key) else order
+
+    table = reports.take(order)
+    table.insert(table.columns.get_loc(announce_col) + 1, EFFECTIVE_COL,
+                 effective[order].view('datetime64[D]').astype('datetime64[ns]'))
+    return table.reset_index(drop=True)
+
+
+def asof_join(panel: pd.DataFrame,
+              reports: pd.DataFrame,
+              fields: Union[list, None] = None,
+              symbol_col: str = 'symbol',
+              date_col: str = 'date',
+              announce_col: str = 'ann_date',
+              period_col: str = 'period',
+              calendar_path: str = 'SSE',
+              lag: int = 0,
+              max_staleness: Union[int, str, pd.Timedelta, None] = None) -> pd.DataFrame:
+    """
+    Point-in-time as-of join of financial report data onto a daily panel in one vectorized pass: each row of the panel
+    gets the latest report known as of its date, the latest report period with its latest restatement, see pit_table.
+    Equivalent to pd.merge_asof by symbol on the point-in-time table, without per-symbol loops.
+
+    :param panel: daily data, including columns "symbol" and "date", in any row order
+    :param reports: filings, including columns "symbol", "ann_date", "period" and the fields
+    :param fields: columns of reports to join, all the other columns by default
+    :param lag: a filing is effective lag trading days after its announcement, see pit_table
+    :param max_staleness: values effective more than max_staleness before the date are not forward-filled (NaN),
+        an int counts trading days of the calendar, a Timedelta or string (e.g. "180D") counts calendar time
+    :return: DataFrame with the same index as panel, including the fields, the period, the announcement date
+        and the effective date of the joined filing
+    """
+    calendar = calutils.get_calendar(calendar_path)
+    table = pit_table(reports, symbol_col=symbol_col, announce_col=announce_col, period_col=period_col,
+                      calendar_path=calendar_path, lag=lag)
+    if fields is None:
+        fields = [col for col in table.columns if col not in (symbol_col, announce_col, period_col, EFFECTIVE_COL)]
+
+    ## the point-in-time table is sorted by symbol, so its codes are ascending and index the sorted symbols
+    ## 时点表按股票代码排序，其编码递增且对应有序的股票代码
+    table_codes, symbols = pd.factorize(table[symbol_col], sort=True)
+    codes = symbols.get_indexer(panel[symbol_col])
+    table_days = table[EFFECTIVE_COL].to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').view(np.int64)
+    days = panel[date_col].to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').view(np.int64)
+    valid = (codes >= 0) & (days != calutils.TradingCalendar.NAT)
+
+    ## (symbol, day) in one sorted key, the last filing not later than the date is found by a single searchsorted
+    ## (股票, 日期)合并为一个有序键，一次searchsorted找到不晚于当日的最后一条公告
+    matched = np.zeros(len(panel), dtype=bool)
+    pos = np.zeros(len(panel), dtype=np.int64)
+    if len(table) and valid.any():
+        low = min(table_days.min(), days[valid].min())
+        span = max(table_days.max(), days[valid].max()) - low + 1
+        table_key = table_codes * span + (table_days - low)
+        key = np.where(valid, codes * span + (days - low), -1)
+        pos = (np.searchsorted(table_key, key, side='right') - 1).clip(0)
+        matched = valid & (table_codes[pos] == codes) & (table_days[pos] <= days)
+
+    ## values older than max_staleness are not forward-filled
+    ## 超过最大过期时间的数据不再向前填充
+    if max_staleness is not None and len(table):
+        if isinstance(max_staleness, (int, np.integer)):
+            stale = (calendar.positions(days.view('datetime64[D]'), side='right')
+                     - calendar.positions(table_days[pos].view('datetime64[D]'), side='right'))
+            matched &= stale <= max_staleness
+        else:
+            matched &= (days - table_days[pos]) <= pd.Timedelta(max_staleness) / pd.Timedelta(days=1)
+
+    indexer = np.where(matched, pos, -1)
+    return pd.DataFrame({col: pd.api.extensions.take(table[col].to_numpy(), indexer, allow_fill=True)
+                         for col in [*fields, period_col, announce_col, EFFECTIVE_COL]},
+                        index=panel.index, copy=False)
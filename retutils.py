@@ -1,8 +1,140 @@
 import pandas as pd
 import numpy as np
-import datetime
+import hashlib
+import functools
+import glob
+import os
+import re
+import shutil
+import tempfile
+import warnings
+from typing import Union
 import parallelmap
 import extpandas
+import calutils
+
+
+class CumGross:
+    """
+    Prefix sums of log gross returns log(1 + ret), so that the compounded return of any
+    row range [lo, hi) is obtained in O(1) and all horizons can share one pass over the data.
+    Zero and negative gross returns (e.g. delisting at -100%) are tracked by counters so that
+    the logarithm is never taken on them.
+    """
+
+    def __init__(self, rets: np.ndarray, skipna: bool = False):
+        """
+        :param rets: simple returns
+        :param skipna: if True, NaN returns are treated as 0, else any NaN in a range makes its result NaN
+        """
+        gross = 1.0 + np.asarray(rets, dtype=np.float64)
+        nan = np.isnan(gross)
+        zero = gross == 0
+        negative = gross < 0
+        gross = np.where(nan | zero, 1.0, gross)
+
+        self.cum_log = self._prefix(np.log(np.abs(gross)))
+        ## the counters are only kept when they are needed
+        ## 只在需要时保留计数器
+        self.cum_nan = self._prefix(nan) if not skipna and nan.any() else None
+        self.cum_zero = self._prefix(zero) if zero.any() else None
+        self.cum_negative = self._prefix(negative) if negative.any() else None
+
+    @staticmethod
+    def _prefix(values: np.ndarray):
+        prefix = np.zeros(len(values) + 1, dtype=np.float64 if values.dtype.kind == 'f' else np.int64)
+        np.cumsum(values, out=prefix[1:])
+        return prefix
+
+    def compound(self, lo: np.ndarray, hi: np.ndarray):
+        """
+        Compounded return prod(1 + ret[lo:hi]) - 1 for every pair of bounds
+        """
+        result = np.exp(self.cum_log[hi] - self.cum_log[lo])
+        if self.cum_negative is not None:
+            result[(self.cum_negative[hi] - self.cum_negative[lo]) % 2 == 1] *= -1
+        if self.cum_zero is not None:
+            result[self.cum_zero[hi] > self.cum_zero[lo]] = 0.0
+        result -= 1.0
+        if self.cum_nan is not None:
+            result[self.cum_nan[hi] > self.cum_nan[lo]] = np.nan
+        return result
+
+
+
+def _concat_ranges(lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    ## concatenation of the ranges [lo[k], hi[k]) without a python loop
+    ## 不使用循环拼接多个区间[lo[k], hi[k])
+    lengths = hi - lo
+    starts = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) - np.repeat(starts - lo, lengths)
+
+class ResultCache:
+    """
+    Opt-in on-disk cache of result arrays, one uncompressed .npz file (one array per column) per key.
+    The total size is bounded by least-recently-used eviction, using the modification time of the files
+    (touched on every hit). Files are written to a temporary name and atomically renamed, so several processes
+    can share the directory: readers never see a partial file, and a file evicted by another process is a miss.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 1 << 30):
+        """
+        :param cache_dir: directory of the cache files
+        :param max_bytes: maximum total size of the cache files
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def get(self, key: str) -> Union[dict, None]:
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return arrays
+
+    def put(self, key: str, arrays: dict):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._evict()
+
+    def _evict(self):
+        ## remove the least recently used files until the total size fits in max_bytes
+        ## 删除最久未使用的文件，直到总大小不超过max_bytes
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
 
 
 class RetCalc:
@@ -11,12 +143,28 @@ class RetCalc:
                  calendar_path: str = 'SSE.csv',
                  symbol_col: str = 'symbol',
                  date_col: str = 'date',
-                 ret_col: str = 'ret'):
+                 ret_col: str = 'ret',
+                 cache_dir: Union[str, None] = None,
+                 cache_size: int = 1 << 30,
+                 compact: bool = False,
+                 ret_dtype=np.float64):
         """
         :param data: returns data，including columns "symbol", "date" and "ret",
+        :param calendar_path: exchange name of a bundled calendar ("SSE", "SZSE", "HKEX", "NYEX", "NASDAQ")
+            or path to a calendar csv file
+        :param cache_dir: if given, results are cached on disk in this directory, keyed by a fingerprint of
+            the data, the calendar and the parameters
+        :param cache_size: maximum size in bytes of the cache directory
+        :param compact: if True, the panel is kept as symbol-contiguous column arrays (symbol offsets, int32 day
+            ordinals and returns) and the reference to data is dropped, so that data can be released by the caller.
+            Only the vectorized engines are available, without inplace, append and update.
+        :param ret_dtype: dtype of the returns kept in compact mode, e.g. np.float32 halves their memory,
+            the calculation is always done in float64 and the ret_pM_pN columns are returned in this dtype
         """
         self.data = data
+        self.index = data.index
         self.calendar = None
+        self.trading_calendar = None
         self.grouped = None
 
         self.calendar_path = calendar_path
@@ -26,14 +174,193 @@ class RetCalc:
         self.date_col = date_col
         self.ret_col = ret_col
 
+        ## symbol-contiguous layout used by the vectorized engines
+        ## 向量化计算使用的按股票连续排列的数据布局
+        self.order = None
+        self.offsets = None
+
+        ## optional on-disk result cache
+        ## 可选的磁盘结果缓存
+        self.cache = None if cache_dir is None else ResultCache(cache_dir, cache_size)
+        self.fingerprint = None
+
+        ## the first row and the number of rows of each symbol appended by the last call of append
+        ## 最近一次append追加的第一行位置，以及每只股票追加的行数
+        self.append_start = None
+        self.append_counts = None
+
+        ## column arrays of the compact mode, in the symbol-contiguous order
+        ## 紧凑模式下按股票连续排列的列数组
+        self.compact = compact
+        self.ret_dtype = np.dtype(ret_dtype)
+        self.columns = None
+        if compact:
+            self._gen_compact()
+
     def _load_calendar(self):
-        ## load trading day calendar
-        self.calendar = pd.read_csv(self.calendar_path, header=None, parse_dates=[0])[0]
+        ## load trading day calendar from the process-wide registry, compiled and memory-mapped only once
+        ## 从进程级交易日历注册表加载，交易日历只编译和映射一次
+        self.trading_calendar = calutils.get_calendar(self.calendar_path)
+        self.calendar = self.trading_calendar.to_series()
 
     def _gen_grouped(self):
         ## group the data by symbol before the calculation of stock returns
+        if self.compact:
+            raise ValueError("engine='loky' needs the DataFrame, which is not kept in compact mode")
         self.grouped = self.data.groupby(self.symbol_col)
-        self.symbols = self.data[self.symbol_col].unique()
+        ## the sorted symbols of the symbol-contiguous layout index its codes and must not be replaced
+        ## 按股票连续排列的布局以有序股票代码作为编码索引，不能被替换
+        if self.offsets is None:
+            self.symbols = self.data[self.symbol_col].unique()
+
+    def _gen_offsets(self):
+        ## stable-sort the rows by symbol so that each symbol occupies a contiguous block [offsets[g], offsets[g+1])
+        ## the date order inside each symbol is kept, rows with missing symbol are put before offsets[0]
+        ## 按股票代码稳定排序，使每只股票占据连续区间[offsets[g], offsets[g+1])，股票内部保持原有日期顺序
+        codes, self.symbols = pd.factorize(self.data[self.symbol_col], sort=True)
+        if np.all(codes[1:] >= codes[:-1]):
+            ## already grouped by symbol, no reordering needed
+            ## 数据已经按股票排列，无需重排
+            self.order = None
+            sorted_codes = codes
+        else:
+            self.order = np.argsort(codes, kind='stable')
+            sorted_codes = codes[self.order]
+        n_missing = np.searchsorted(sorted_codes, 0)
+        counts = np.bincount(sorted_codes[n_missing:], minlength=codes.max(initial=-1) + 1)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]) + n_missing
+
+    def _gen_compact(self):
+        ## convert the panel to symbol-contiguous column arrays: the symbols are kept as the sorted symbol index
+        #   and the offsets of their blocks, the dates as int32 day ordinals (days since 1970-01-01, the unit of
+        #   the trading calendar) and the returns in ret_dtype, then drop the reference to the DataFrame
+        ## 将面板转换为按股票连续排列的列数组：股票代码保存为有序代码表及各股票区间的偏移量，日期保存为int32日序数
+        #   （自1970-01-01起的天数，与交易日历单位一致），收益率保存为ret_dtype，然后释放对DataFrame的引用
+        self._gen_offsets()
+        days = self.data[self.date_col].to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').view(np.int64)
+        if np.any(days == calutils.TradingCalendar.NAT):
+            raise ValueError(f'column {self.date_col!r} has missing dates, which are not supported in compact mode')
+        rets = self.data[self.ret_col].to_numpy(dtype=self.ret_dtype)
+        if self.order is not None:
+            days, rets = days[self.order], rets[self.order]
+            if len(self.order) < np.iinfo(np.int32).max:
+                self.order = self.order.astype(np.int32)
+        self.columns = {self.date_col: days.astype(np.int32), self.ret_col: rets}
+        self.data = None
+
+    def _gen_fingerprint(self):
+        ## fingerprint of the symbol, date and return columns in row order, used as the cache key of the data
+        ## 股票代码、日期和收益率列的指纹，作为数据的缓存键
+        digest = hashlib.blake2b(digest_size=16)
+        if self.compact:
+            ## the compact arrays are hashed in their own layout, so they never share entries with the DataFrame
+            ## 紧凑模式按其自身布局计算指纹，不与DataFrame模式共用缓存
+            digest.update(pd.util.hash_pandas_object(self.symbols, index=False).to_numpy().tobytes())
+            digest.update(self.offsets.tobytes())
+            if self.order is not None:
+                digest.update(self.order.tobytes())
+            for values in self.columns.values():
+                digest.update(values.tobytes())
+            self.fingerprint = digest.hexdigest()
+            return
+        digest.update(pd.util.hash_pandas_object(self.data[self.symbol_col], index=False).to_numpy().tobytes())
+        digest.update(self.data[self.date_col].to_numpy(dtype='datetime64[ns]').tobytes())
+        digest.update(self.data[self.ret_col].to_numpy(dtype=np.float64).tobytes())
+        self.fingerprint = digest.hexdigest()
+
+    def _cache_get(self, *params):
+        ## get the cached arrays of the parameters, None if not cached or the cache is disabled
+        ## 读取参数对应的缓存数组，未缓存或未启用缓存时返回None
+        if self.cache is None:
+            return None
+        if self.fingerprint is None:
+            self._gen_fingerprint()
+        return self.cache.get(self.cache.key(self.fingerprint, *params))
+
+    def _cache_put(self, arrays: dict, *params):
+        if self.cache is not None:
+            self.cache.put(self.cache.key(self.fingerprint, *params), arrays)
+
+    def _sorted_values(self, col):
+        ## values of a column in the symbol-contiguous order
+        ## 按股票连续顺序排列的列数据
+        if self.compact:
+            return self.columns[col]
+        values = self.data[col].to_numpy()
+        return values if self.order is None else values[self.order]
+
+    def _unsort_values(self, values):
+        ## scatter values computed in the symbol-contiguous order back to the original row order
+        ## 将按股票连续顺序计算的结果还原为原始行顺序
+        if self.order is None:
+            return values
+        result = np.empty_like(values)
+        result[self.order] = values
+        return result
+
+    def append(self, new_data: pd.DataFrame):
+        ## append newly arrived rows, the rows of each symbol must be later than its existing rows
+        ## the symbol-contiguous layout is merged incrementally instead of sorting the whole panel again,
+        #   the results computed before appending can then be updated by ret_pM_pN_update and ret_m_K_update
+        ## 追加新到达的数据行，每只股票的新数据须晚于其已有数据
+        ## 增量合并按股票连续排列的数据布局，无需对整个面板重新排序，追加前的计算结果可通过update方法更新
+        if self.compact:
+            raise ValueError('append is not supported in compact mode')
+        if self.offsets is None:
+            self._gen_offsets()
+        n_old = len(self.data)
+
+        ## remap the codes of old and new rows to the sorted union of symbols, code -1 is the missing symbol
+        ## 将新旧数据的股票编码映射到合并后的有序股票列表，编码-1为缺失股票代码
+        new_codes, new_symbols = pd.factorize(new_data[self.symbol_col], sort=True)
+        symbols = self.symbols.union(new_symbols)
+        old_map = np.append(symbols.get_indexer(self.symbols), -1)
+        new_map = np.append(symbols.get_indexer(new_symbols), -1)
+        old_codes = np.repeat(np.arange(-1, len(self.symbols)), np.diff(self.offsets, prepend=0))
+        old_codes = old_map[old_codes]
+        new_order = np.argsort(new_map[new_codes], kind='stable')
+        new_codes = new_map[new_codes][new_order]
+
+        ## in the merged layout the old rows of each symbol are followed by its new rows
+        ## 合并后的布局中，每只股票的旧数据之后紧跟其新数据
+        old_counts = np.bincount(old_codes + 1, minlength=len(symbols) + 1)
+        new_counts = np.bincount(new_codes + 1, minlength=len(symbols) + 1)
+        offsets = np.cumsum(old_counts + new_counts)
+        ## an old row moves back by the new rows of the symbols before it, a new row by the old rows up to its symbol
+        ## 旧数据行后移其之前股票的新数据行数，新数据行后移截至其股票的旧数据行数
+        order = np.empty(n_old + len(new_data), dtype=np.int64)
+        order[np.arange(n_old) + np.cumsum(new_counts)[old_codes + 1] - new_counts[old_codes + 1]] = \
+            np.arange(n_old) if self.order is None else self.order
+        order[np.arange(len(new_data)) + np.cumsum(old_counts)[new_codes + 1]] = new_order + n_old
+
+        data = pd.concat([self.data, new_data])
+        dates = data[self.date_col].to_numpy(dtype='datetime64[ns]')[order]
+        boundary = (offsets - new_counts)[1:][(old_counts[1:] > 0) & (new_counts[1:] > 0)]
+        if np.any(dates[boundary] <= dates[boundary - 1]):
+            raise ValueError('the appended rows of each symbol must be later than its existing rows')
+
+        self.data = data
+        self.index = data.index
+        self.symbols = symbols
+        self.order = None if np.array_equal(order, np.arange(len(order))) else order
+        self.offsets = offsets
+        self.append_start = n_old
+        self.append_counts = new_counts[1:]
+        self.grouped = None
+        self.fingerprint = None
+
+    def _appended_groups(self):
+        ## the groups with appended rows, and the position of their first appended row in the symbol-contiguous layout
+        ## 有追加数据的股票，及其第一条追加数据在按股票连续排列布局中的位置
+        if self.append_start is None:
+            raise ValueError('no rows have been appended, call append first')
+        groups = np.flatnonzero(self.append_counts)
+        return groups, self.offsets[groups + 1] - self.append_counts[groups]
+
+    def _sorted_take(self, col, positions):
+        ## values of a column at positions of the symbol-contiguous layout
+        ## 按股票连续排列布局中指定位置的列数据
+        return self.data[col].to_numpy()[positions if self.order is None else self.order[positions]]
 
     ###############################################
     ##  Calculating the cumulative return rate   ##
@@ -46,12 +373,126 @@ class RetCalc:
 
     @classmethod
     def ret_pM_pN_core(cls, grouped, M=1, N=5, **kwargs):
+        ## legacy engine: rolling product on each reversed symbol group, parallelized over groups
+        ## 原始实现：对每个股票逆序滚动累乘，按分组多进程并行
         return extpandas.parallel_groupby_apply(grouped, lambda x: x.iloc[::-1].rolling(N - M + 1).apply(
             lambda x: (1 + x).prod() - 1).shift(M).iloc[::-1], **kwargs)
 
-    def ret_pM_pN(self, M, N, inplace=False, **kwargs):
+    @classmethod
+    def ret_pM_pN_vec(cls, rets: np.ndarray, offsets: np.ndarray, pairs):
+        ## vectorized engine over the whole panel, all (M, N) pairs share the same prefix sums
+        ## input: returns ordered so that symbol g occupies rows [offsets[g], offsets[g+1]) in ascending date order
+        ## output: dictionary {(M, N): array of ret_pM_pN aligned with rets}
+        ## 向量化计算引擎：整个面板一次计算，所有(M, N)组合共享同一组前缀和
+        ## 输入：按股票连续排列的收益率，股票g位于[offsets[g], offsets[g+1])行，日期升序
+        n = len(rets)
+        cum_gross = CumGross(rets)
+
+        ## the end (exclusive) of the symbol block each row belongs to, 0 for rows outside any block
+        ## 每行所属股票区间的结束位置（不含），不属于任何股票的行为0
+        group_end = np.zeros(n, dtype=np.int64)
+        group_end[offsets[0]:offsets[-1]] = np.repeat(offsets[1:], np.diff(offsets))
+        rows = np.arange(n)
+
+        results = {}
+        for M, N in pairs:
+            assert N >= M >= 1
+            ## the window t+M..t+N must stay inside the block of symbol at t
+            ## t+M到t+N的窗口不能越过当前股票的区间
+            valid = rows + N < group_end
+            lo = np.where(valid, rows + M, 0)
+            hi = np.where(valid, rows + N + 1, 0)
+            result = cum_gross.compound(lo, hi)
+            result[~valid] = np.nan
+            results[(M, N)] = result
+        return results
+
+    def ret_pM_pN_batch(self, pairs, inplace=False):
+        ## calculate several ret_pM_pN columns in one pass, pairs is a list of (M, N)
+        ## 一次计算多个ret_pM_pN列，pairs为(M, N)列表
+        pairs = [(int(M), int(N)) for M, N in pairs]
+        for M, N in pairs:
+            assert N >= M >= 1
+        if inplace and self.compact:
+            raise ValueError('inplace is not supported in compact mode, the DataFrame is not kept')
+        if self.offsets is None:
+            self._gen_offsets()
+
+        ## look up the cache first, the missing pairs share one pass of the engine
+        ## 先查询缓存，未缓存的期限共享一次引擎计算
+        results = {}
+        for M, N in pairs:
+            arrays = self._cache_get('ret_pM_pN', M, N)
+            if arrays is not None:
+                results[(M, N)] = arrays['ret']
+        missing = [pair for pair in pairs if pair not in results]
+        if missing:
+            results.update(self.ret_pM_pN_vec(self._sorted_values(self.ret_col), self.offsets, missing))
+            for M, N in missing:
+                self._cache_put({'ret': results[(M, N)]}, 'ret_pM_pN', M, N)
+        dtype = self.ret_dtype if self.compact else np.float64
+        results = pd.DataFrame({f'ret_p{M}_p{N}': self._unsort_values(results[(M, N)].astype(dtype, copy=False))
+                                for M, N in pairs}, index=self.index, copy=False)
+        if inplace:
+            for col in results.columns:
+                self.data[col] = results[col]
+            return
+        else:
+            return results
+
+    def ret_pM_pN_update(self, prev: pd.DataFrame, inplace=False):
+        ## update the ret_pM_pN columns computed before the last append, prev holds the columns "ret_p{M}_p{N}"
+        ## only the last N old rows and the new rows of the symbols with appended rows are recomputed
+        ## 更新最近一次append之前计算的ret_pM_pN列，prev包含"ret_p{M}_p{N}"列
+        ## 只重新计算有追加数据的股票的最后N行旧数据和新数据
+        pairs = []
+        for col in prev.columns:
+            match = re.fullmatch(r'ret_p(\d+)_p(\d+)', str(col))
+            if match is None:
+                raise ValueError(f'unexpected column {col!r} in prev, expected "ret_p{{M}}_p{{N}}"')
+            pairs.append((int(match.group(1)), int(match.group(2))))
+        groups, first_new = self._appended_groups()
+        if len(prev) != self.append_start:
+            raise ValueError(f'prev has {len(prev)} rows, expected the {self.append_start} rows before the last append')
+
+        ## the windows of the recomputed rows stay inside the recomputed tails, so the tails form a smaller panel
+        ## 重新计算行的窗口不会越出重新计算的尾部区间，因此尾部区间可以组成一个较小的面板计算
+        max_N = max(N for M, N in pairs)
+        lo = np.maximum(self.offsets[groups], first_new - max_N)
+        hi = self.offsets[groups + 1]
+        tails = _concat_ranges(lo, hi)
+        offsets = np.concatenate([[0], np.cumsum(hi - lo)])
+        tails_results = self.ret_pM_pN_vec(self._sorted_take(self.ret_col, tails), offsets, pairs)
+
+        rows = tails if self.order is None else self.order[tails]
+        results = {}
+        for M, N in pairs:
+            result = np.full(len(self.data), np.nan)
+            result[:self.append_start] = prev[f'ret_p{M}_p{N}'].to_numpy(dtype=np.float64)
+            result[rows] = tails_results[(M, N)]
+            results[f'ret_p{M}_p{N}'] = result
+        results = pd.DataFrame(results, index=self.index)
+        if inplace:
+            for col in results.columns:
+                self.data[col] = results[col]
+            return
+        return results
+
+    def ret_pM_pN(self, M, N, inplace=False, engine='numpy', **kwargs):
         ## N must be greater than M
         assert N >= M >= 1
+
+        ## the vectorized engine is used by default, engine='loky' uses the legacy multiprocessing engine with kwargs
+        ## 默认使用向量化引擎，engine='loky'时使用原多进程引擎，kwargs传入进程池
+        if engine == 'numpy':
+            if kwargs:
+                warnings.warn(f"{', '.join(kwargs)} ignored by engine='numpy', they apply to engine='loky' only",
+                              stacklevel=2)
+            result = self.ret_pM_pN_batch([(M, N)], inplace=inplace)
+            return None if inplace else result[f'ret_p{M}_p{N}']
+        elif engine != 'loky':
+            raise ValueError(f"unknown engine {engine!r}, expected 'numpy' or 'loky'")
+
         ## If the group is not loaded, it will be loaded first
         ## 如果未加载分组，则先加载分组
         if self.grouped is None:
@@ -60,10 +501,10 @@ class RetCalc:
         ## When inplace is True, add the response column in the source data; otherwise return the result column
         ## 当inplace为True时，在源数据中添加响应列；否则返回结果列
         if inplace:
-            self.data[f'ret_p{M}_p{N}'] = self.ret_pM_pN_core(self.grouped['ret'], M, N, **kwargs)
+            self.data[f'ret_p{M}_p{N}'] = self.ret_pM_pN_core(self.grouped[self.ret_col], M, N, **kwargs)
             return
         else:
-            return self.ret_pM_pN_core(self.grouped['ret'], M, N, **kwargs)
+            return self.ret_pM_pN_core(self.grouped[self.ret_col], M, N, **kwargs)
 
     ##############################################
     ##  Calculate monthly returns, you can      ##
@@ -73,35 +514,18 @@ class RetCalc:
     ######################################################
     ##  计算月度收益率，可自定义每个月的开始日期，增强分析稳健性  ##
     ######################################################
-    def _key_day_mask(self, x: pd.DataFrame, key_day: int):
-        ## check if the date is the key day(the seperation day of month)
-        ## 检查日期是否为关键日期（月份分割日）
-        d: pd.Series = x['calendar']
-        ## the previous trading day of current date
-        ## 当前交易日的前一个交易日
-        d_pre: pd.Series = x['calendar_pre']
-        key_day_datetime = datetime.datetime(d.year, d.month, key_day)
-        return d >= key_day_datetime and d_pre < key_day_datetime
-
     def _gen_start_end(self, T):
         ## generate the start and end date DataFrame of each month according to the key day setting
         ## 根据自定义月起始日设置生成每个月的开始日期和结束日期DataFrame
 
         ## if the calendar is not loaded, load it first
-        ## 如果没有加载交易日日历则先加载，同时加载交易日和上一个交易日
-        if self.calendar is None:
+        ## 如果没有加载交易日日历则先加载
+        if self.trading_calendar is None:
             self._load_calendar()
 
-        calendar_df = pd.DataFrame({'calendar': self.calendar, 'calendar_pre': self.calendar.shift(1)})
-
-        ## select the start and end date for each month
-        ## 筛选出每个月开始日和结束日
-        calendar_df = calendar_df[calendar_df.apply(lambda x: self._key_day_mask(x, T), axis=1)]
-        calendar_df['calendar_pre'] = calendar_df['calendar_pre'].shift(-1)
-        calendar_df.columns = ['start', 'end']
-
         ## generate and store in dictionary
         ## 生成后存储在字典中
+        calendar_df = self.trading_calendar.start_end(T)
         self.start_end[T] = calendar_df
         return calendar_df
 
@@ -169,13 +593,197 @@ class RetCalc:
                 i += 1
         return pd.DataFrame(results, columns=[symbol_col, 'start', 'end', 'end_expected', f'ret_m_{key_day}'])
 
-    def ret_m_K(self, key_day: int, **kwargs):
+    @classmethod
+    def ret_m_K_vec(cls,
+                    dates: np.ndarray,
+                    rets: np.ndarray,
+                    offsets: np.ndarray,
+                    calendar: np.ndarray,
+                    start_ends: dict):
+        ## vectorized engine for all symbols and several key days at once
+        ## input: dates (datetime64[ns]) and returns ordered so that symbol g occupies rows [offsets[g], offsets[g+1])
+        #   in ascending date order, the trading day calendar and a dictionary {key_day: start/end DataFrame}
+        #   dates and calendar can also be integer day ordinals (days since 1970-01-01), as in compact mode
+        ## output: dictionary {key_day: (group, start row, end row, expected end date, monthly return)}
+        ## 向量化计算引擎：一次计算全部股票、多个key_day
+        ## 输入：按股票连续排列、日期升序的日期和收益率，交易日历，以及{key_day: 起止日期表}字典
+        n = len(dates)
+        n_groups = len(offsets) - 1
+        group = np.full(n, -1, dtype=np.int64)
+        group[offsets[0]:offsets[-1]] = np.repeat(np.arange(n_groups), np.diff(offsets))
+
+        ## rank each date by the number of trading days not later than it, so that (group, date) fits in one sorted key
+        ## "date >= end" is equivalent to "rank(date) >= rank(end)" since every end date is a trading day
+        ## 以不晚于该日期的交易日数量作为日期排名，使(股票, 日期)可以合并为一个有序键
+        span = len(calendar) + 1
+        key = group * span + np.searchsorted(calendar, dates, side='right')
+
+        ## NaN returns are skipped as in prod(skipna=True)
+        ## 与prod(skipna=True)一致，忽略缺失收益率
+        cum_gross = CumGross(rets, skipna=True)
+
+        results = {}
+        for key_day, calendar_df in start_ends.items():
+            starts = calendar_df['start'].to_numpy(dtype='datetime64[ns]')
+            ends = calendar_df['end'].to_numpy(dtype='datetime64[ns]')
+            has_end = ~np.isnat(ends)
+            if dates.dtype.kind in 'iu':
+                ## compare day ordinals with day ordinals, the missing end is never read since has_end is False
+                ## 以日序数比较，缺失的结束日期因has_end为False不会被使用
+                starts = starts.astype('datetime64[D]').view(np.int64)
+                ends = ends.astype('datetime64[D]').view(np.int64)
+
+            ## pair each day with the latest key date not after it, as merge_asof does
+            ## 配对关键日期，使得每日对应最近的关键日期
+            month = np.searchsorted(starts, dates, side='right') - 1
+            month_safe = month.clip(0)
+
+            ## the month starts at row i only if the stock is traded on the start day (exact match),
+            #   months without expected end (the last one in the calendar) are never complete
+            ## 精确匹配起始日期，当日停牌则无数据；日历中最后一个月没有结束日期，不计算
+            i = np.flatnonzero((group >= 0) & (month >= 0) & (dates == starts[month_safe]) & has_end[month_safe])
+            end_expected = ends[month[i]]
+
+            ## the month ends at the first row of the same stock not earlier than the expected end,
+            #   i.e. it rolls forward to the resume day if the stock is suspended on the expected end
+            ## 结束于同一股票不早于预期结束日的第一行，若预期结束日停牌则顺延至复牌首日
+            target = group[i] * span + np.searchsorted(calendar, end_expected, side='right')
+            j = np.searchsorted(key, target, side='left')
+            complete = j < offsets[group[i] + 1]
+            i, j, end_expected = i[complete], j[complete], end_expected[complete]
+            if end_expected.dtype.kind != 'M':
+                end_expected = end_expected.astype('datetime64[D]').astype('datetime64[ns]')
+
+            ## the cumulative return of rows i..j inclusive, the end row may also start the next month
+            ## 累计第i到第j行（含）的收益率，结束行同时可以是下个月的开始行
+            results[key_day] = (group[i], i, j, end_expected, cum_gross.compound(i, j + 1))
+        return results
+
+    def ret_m_K_batch(self, key_days):
+        ## calculate monthly returns for several key days in one call, returns a dictionary {key_day: DataFrame}
+        ## 一次计算多个key_day的月度收益率，返回{key_day: DataFrame}字典
+        key_days = [int(key_day) for key_day in key_days]
+        for key_day in key_days:
+            assert 1 <= key_day <= 28
+
+        if self.offsets is None:
+            self._gen_offsets()
+        if self.calendar is None:
+            self._load_calendar()
+
+        ## compact mode works on the day ordinals directly, without a datetime64[ns] copy of the dates
+        ## 紧凑模式直接使用日序数计算，无需复制为datetime64[ns]日期
+        if self.compact:
+            dates = self._sorted_values(self.date_col)
+            calendar = self.trading_calendar.days
+        else:
+            dates = self._sorted_values(self.date_col).astype('datetime64[ns]')
+            calendar = self.calendar.to_numpy(dtype='datetime64[ns]')
+
+        ## look up the cache first, the missing key days share one pass of the engine
+        ## 先查询缓存，未缓存的key_day共享一次引擎计算
+        fields = ['group', 'i', 'j', 'end_expected', 'ret']
+        results = {}
+        for key_day in key_days:
+            arrays = self._cache_get('ret_m_K', self.trading_calendar.fingerprint, key_day)
+            if arrays is not None:
+                results[key_day] = tuple(arrays[field] for field in fields)
+        missing = [key_day for key_day in key_days if key_day not in results]
+        if missing:
+            results.update(self.ret_m_K_vec(dates=dates,
+                                            rets=self._sorted_values(self.ret_col),
+                                            offsets=self.offsets,
+                                            calendar=calendar,
+                                            start_ends={key_day: self.get_start_end(key_day) for key_day in missing}))
+            for key_day in missing:
+                self._cache_put(dict(zip(fields, results[key_day])),
+                                'ret_m_K', self.trading_calendar.fingerprint, key_day)
+
+        return {key_day: self._ret_m_K_frame(key_day, dates, *results[key_day]) for key_day in key_days}
+
+    def _ret_m_K_frame(self, key_day, dates, group, i, j, end_expected, ret):
+        ## monthly return DataFrame from the output of ret_m_K_vec
+        ## 由ret_m_K_vec的输出生成月度收益率DataFrame
+        if self.compact:
+            ## symbols as categorical codes, day ordinals converted only for the rows of the result
+            ## 股票代码以分类编码输出，只对结果行转换日序数
+            return pd.DataFrame({self.symbol_col: pd.Categorical.from_codes(group, categories=self.symbols),
+                                 'start': dates[i].astype('datetime64[D]').astype('datetime64[ns]'),
+                                 'end': dates[j].astype('datetime64[D]').astype('datetime64[ns]'),
+                                 'end_expected': end_expected,
+                                 f'ret_m_{key_day}': ret}, copy=False)
+        return pd.DataFrame({self.symbol_col: self.symbols.take(group),
+                             'start': dates[i],
+                             'end': dates[j],
+                             'end_expected': end_expected,
+                             f'ret_m_{key_day}': ret})
+
+    def ret_m_K_update(self, key_day: int, prev: pd.DataFrame):
+        ## update the monthly returns computed before the last append, only the months not yet complete
+        #   (expected end after the last old row) of the symbols with appended rows are recomputed
+        ## 更新最近一次append之前计算的月度收益率，只重新计算有追加数据的股票尚未结束（预期结束日晚于最后一行旧数据）的月份
+        assert 1 <= key_day <= 28
+        groups, first_new = self._appended_groups()
+        if self.calendar is None:
+            self._load_calendar()
+        calendar = self.calendar.to_numpy(dtype='datetime64[ns]')
+        calendar_df = self.get_start_end(key_day)
+        starts = calendar_df['start'].to_numpy(dtype='datetime64[ns]')
+        ends = calendar_df['end'].to_numpy(dtype='datetime64[ns]')
+
+        ## the first open month of each symbol starts the recomputation, the whole symbol if it has no old rows
+        ## 每只股票从第一个未结束的月份开始重新计算，没有旧数据的股票全部计算
+        has_old = first_new > self.offsets[groups]
+        last_old = self._sorted_take(self.date_col, np.where(has_old, first_new - 1, 0)).astype('datetime64[ns]')
+        ends = np.where(np.isnat(ends), np.datetime64('2262-04-11', 'ns'), ends)
+        cutoff = starts[np.searchsorted(ends, last_old, side='right').clip(max=len(starts) - 1)]
+        cutoff = np.where(has_old, cutoff, np.datetime64('1678-01-01', 'ns'))
+
+        ## bisect the first row not earlier than the cutoff in the old rows of all symbols at once
+        ## 在各股票的旧数据中同时二分查找第一行不早于cutoff的数据
+        lo, hi = self.offsets[groups], first_new
+        while np.any(lo < hi):
+            mid = (lo + hi) // 2
+            before = (lo < hi) & (self._sorted_take(self.date_col, np.minimum(mid, first_new - 1)) < cutoff)
+            lo, hi = np.where(before, mid + 1, lo), np.where(before | (lo >= hi), hi, mid)
+        hi = self.offsets[groups + 1]
+        tails = _concat_ranges(lo, hi)
+        dates = self._sorted_take(self.date_col, tails).astype('datetime64[ns]')
+        sub_group, i, j, end_expected, ret = self.ret_m_K_vec(dates=dates,
+                                                              rets=self._sorted_take(self.ret_col, tails),
+                                                              offsets=np.concatenate([[0], np.cumsum(hi - lo)]),
+                                                              calendar=calendar,
+                                                              start_ends={key_day: calendar_df})[key_day]
+        update = self._ret_m_K_frame(key_day, dates, groups[sub_group], i, j, end_expected, ret)
+
+        ## keep the months of prev starting before the cutoff, and order the rows by symbol and start as in ret_m_K
+        ## 保留prev中开始于cutoff之前的月份，并与ret_m_K一致按股票和开始日期排序
+        prev_group = self.symbols.get_indexer(prev[self.symbol_col])
+        prev_cutoff = np.full(len(self.symbols), np.datetime64('2262-04-11', 'ns'))
+        prev_cutoff[groups] = cutoff
+        keep = prev['start'].to_numpy(dtype='datetime64[ns]') < prev_cutoff[prev_group]
+        datas = pd.concat([prev[keep], update], ignore_index=True)
+        order = np.lexsort((datas['start'].to_numpy(dtype='datetime64[ns]'),
+                            np.concatenate([prev_group[keep], groups[sub_group]])))
+        return datas.take(order).reset_index(drop=True)
+
+    def ret_m_K(self, key_day: int, engine='numpy', **kwargs):
         ## 计算月度收益率，通过key_day指定月度起始日
         ## calculate monthly return rate, specify monthly start date through key_day
         ## input: key_day: the start day of each month
 
         assert 1 <= key_day <= 28
 
+        ## the vectorized engine is used by default, engine='loky' uses the legacy multiprocessing engine with kwargs
+        ## 默认使用向量化引擎，engine='loky'时使用原多进程引擎，kwargs传入进程池
+        if engine == 'numpy':
+            if kwargs:
+                warnings.warn(f"{', '.join(kwargs)} ignored by engine='numpy', they apply to engine='loky' only",
+                              stacklevel=2)
+            return self.ret_m_K_batch([key_day])[key_day]
+        elif engine != 'loky':
+            raise ValueError(f"unknown engine {engine!r}, expected 'numpy' or 'loky'")
+
         ## if the grouping has not been generated, generate the grouping first
         if self.grouped is None:
             self._gen_grouped()
@@ -191,3 +799,194 @@ class RetCalc:
                                                                                       ret_col=self.ret_col),
                                                       **kwargs)
         return datas.reset_index(drop=True)
+
+    @classmethod
+    def stream(cls,
+               source,
+               output_dir: str,
+               pairs=(),
+               key_days=(),
+               calendar_path: str = 'SSE.csv',
+               symbol_col: str = 'symbol',
+               date_col: str = 'date',
+               ret_col: str = 'ret',
+               batch_bytes: int = 1 << 28,
+               output_format: Union[str, None] = None,
+               max_workers: int = parallelmap.CPU_COUNT,
+               progress_bar: bool = True,
+               **kwargs):
+        """
+        Out-of-core mode for panels larger than memory: read a symbol-partitioned dataset (parquet or csv shards,
+        every symbol in exactly one shard) one batch of shards at a time in the worker processes, calculate the
+        returns of each batch with the vectorized engines and write them as partitioned output, so that reading,
+        computing and writing overlap across workers and each worker only holds one batch in memory.
+
+        :param source: directory of shards (searched recursively), glob pattern, or list of shard paths,
+            hive-style directories "symbol=XXX" are accepted when the shards have no symbol column
+        :param output_dir: results are written to output_dir/ret_pM_pN/part-00000.parquet (the input rows with the
+            ret_p{M}_p{N} columns) and output_dir/ret_m_{K}/part-00000.parquet, one part per batch; the parts are
+            written into a staging directory in output_dir and moved into place only if every batch succeeds
+        :param pairs: list of (M, N) of ret_pM_pN
+        :param key_days: list of key days of ret_m_K
+        :param batch_bytes: shards are grouped into batches of about this size on disk, the files of one
+            "symbol=XXX" directory always go to the same batch
+        :param output_format: 'parquet' or 'csv', the format of the first shard by default
+        :param kwargs: key arguments for parallelmap.stream_loky, e.g. max_inflight, timeout, chunksize;
+            a batch exceeding the timeout raises TimeoutError
+        :return: dictionary {"ret_pM_pN" or "ret_m_{K}": list of written paths}
+        """
+        shards = _list_shards(source)
+        if not shards:
+            raise FileNotFoundError(f'no parquet or csv shards found in {source!r}')
+        if output_format is None:
+            output_format = _shard_format(shards[0])
+        batches = _batch_shards(shards, batch_bytes, symbol_col)
+        tasks = [(part, batch) for part, batch in enumerate(batches)]
+
+        ## the batches write into a staging directory, moved into output_dir only when every batch has succeeded,
+        #   so that a failed run never leaves a partial output behind
+        ## 各批次先写入临时目录，全部成功后才移动到output_dir，失败时不会留下不完整的输出
+        names = (['ret_pM_pN'] if pairs else []) + [f'ret_m_{int(key_day)}' for key_day in key_days]
+        os.makedirs(output_dir, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=output_dir)
+        for name in names:
+            os.mkdir(os.path.join(staging, name))
+
+        written = {}
+        seen = set()
+        worker = functools.partial(_stream_batch,
+                                   output_dir=staging,
+                                   pairs=[(int(M), int(N)) for M, N in pairs],
+                                   key_days=[int(key_day) for key_day in key_days],
+                                   calendar_path=calendar_path,
+                                   symbol_col=symbol_col,
+                                   date_col=date_col,
+                                   ret_col=ret_col,
+                                   output_format=output_format)
+        results = parallelmap.stream_loky(worker, tasks, max_workers=max_workers, progress_bar=progress_bar,
+                                          index=True, **kwargs)
+        try:
+            for idx, result in results:
+                if result is None:
+                    ## a timed out batch has no output, it must not pass for an empty one
+                    ## 超时的批次没有输出，不能当作空批次处理
+                    part, batch = tasks[idx]
+                    raise TimeoutError(f'batch {part} ({len(batch)} shards from {batch[0]!r}) timed out, '
+                                       f'its results are not written')
+                symbols, paths = result
+                ## a symbol split across batches would be calculated as two separate histories
+                ## 若股票被拆分到不同批次，会被当作两段独立的历史计算
+                split = seen.intersection(symbols)
+                if split:
+                    raise ValueError(f'the dataset is not partitioned by symbol, '
+                                     f'{sorted(split)[:5]} appear in several batches')
+                seen.update(symbols)
+                for name, path in paths.items():
+                    written.setdefault(name, []).append(path)
+
+            ## move the parts into place
+            ## 将结果分片移动到输出目录
+            for name, paths in written.items():
+                os.makedirs(os.path.join(output_dir, name), exist_ok=True)
+                for k, path in enumerate(paths):
+                    paths[k] = os.path.join(output_dir, name, os.path.basename(path))
+                    os.replace(path, paths[k])
+        finally:
+            results.close()
+            shutil.rmtree(staging, ignore_errors=True)
+        return written
+
+
+SHARD_FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.csv': 'csv', '.gz': 'csv'}
+
+
+def _shard_format(path: str) -> str:
+    return SHARD_FORMATS[os.path.splitext(path)[1].lower()]
+
+
+def _list_shards(source) -> list:
+    ## the shard files of a directory, a glob pattern or a list of paths, in sorted order
+    ## 目录、通配符或路径列表中的分片文件，按路径排序
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            source = glob.glob(os.path.join(source, '**', '*'), recursive=True)
+        else:
+            source = glob.glob(source, recursive=True)
+    return sorted(path for path in source
+                  if os.path.isfile(path) and os.path.splitext(path)[1].lower() in SHARD_FORMATS)
+
+
+def _partition_units(shards: list, symbol_col: str) -> list:
+    ## the files of one hive-style directory "symbol=XXX" form one unit so that a symbol is never split across batches,
+    #   other files are units of their own
+    ## 同一hive风格目录"symbol=XXX"下的文件组成一个单元，使股票不会被拆分到不同批次，其他文件各自为一个单元
+    units = {}
+    for path in shards:
+        match = re.search(rf'^(.*?(?:^|[\\/]){re.escape(symbol_col)}=[^\\/]+)[\\/]', path)
+        units.setdefault(path if match is None else match.group(1), []).append(path)
+    return list(units.values())
+
+
+def _batch_shards(shards: list, batch_bytes: int, symbol_col: str = 'symbol') -> list:
+    ## group consecutive partition units into batches of about batch_bytes on disk
+    ## 将相邻分区单元按磁盘大小约batch_bytes分批
+    batches, batch, size = [], [], 0
+    for unit in _partition_units(shards, symbol_col):
+        batch += unit
+        size += sum(os.path.getsize(path) for path in unit)
+        if size >= batch_bytes:
+            batches.append(batch)
+            batch, size = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _read_shard(path: str, symbol_col: str, date_col: str) -> pd.DataFrame:
+    if _shard_format(path) == 'parquet':
+        data = pd.read_parquet(path)
+        data[date_col] = pd.to_datetime(data[date_col])
+    else:
+        data = pd.read_csv(path, parse_dates=[date_col])
+    if symbol_col not in data.columns:
+        ## hive-style partition directory "symbol=XXX"
+        ## hive风格的分区目录"symbol=XXX"
+        match = re.search(rf'(?:^|[\\/]){re.escape(symbol_col)}=([^\\/]+)[\\/]', path)
+        if match is None:
+            raise ValueError(f'shard {path!r} has no column {symbol_col!r} nor a "{symbol_col}=..." directory')
+        data[symbol_col] = match.group(1)
+    return data
+
+
+def _write_part(data: pd.DataFrame, output_dir: str, name: str, part: int, output_format: str) -> str:
+    ## write atomically so that a failed batch never leaves a partial part
+    ## 原子写入，失败的批次不会留下不完整的分片
+    ## the directory is created by RetCalc.stream, a batch still running after a failed run must not recreate it
+    ## 目录由RetCalc.stream创建，失败后仍在运行的批次不能重新创建该目录
+    path = os.path.join(output_dir, name, f'part-{part:05d}.{output_format}')
+    tmp = f'{path}.{os.getpid()}.tmp'
+    if output_format == 'parquet':
+        data.to_parquet(tmp, index=False)
+    else:
+        data.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+    return path
+
+
+def _stream_batch(task, output_dir, pairs, key_days, calendar_path, symbol_col, date_col, ret_col, output_format):
+    ## worker of RetCalc.stream: read one batch of shards, calculate and write its results
+    ## returns the symbols of the batch and the written paths
+    ## RetCalc.stream的子进程任务：读取一批分片，计算并写出结果
+    part, paths = task
+    data = pd.concat([_read_shard(path, symbol_col, date_col) for path in paths], ignore_index=True)
+    ## the files of a partition are not necessarily named in date order, the engines need ascending dates per symbol
+    ## 分区内的文件名不一定按日期排序，而计算引擎要求每只股票日期升序
+    data = data.sort_values([symbol_col, date_col], kind='stable', ignore_index=True)
+    calculator = RetCalc(data, calendar_path=calendar_path, symbol_col=symbol_col, date_col=date_col, ret_col=ret_col)
+    written = {}
+    if pairs:
+        calculator.ret_pM_pN_batch(pairs, inplace=True)
+        written['ret_pM_pN'] = _write_part(calculator.data, output_dir, 'ret_pM_pN', part, output_format)
+    for key_day, result in (calculator.ret_m_K_batch(key_days) if key_days else {}).items():
+        written[f'ret_m_{key_day}'] = _write_part(result, output_dir, f'ret_m_{key_day}', part, output_format)
+    return set(data[symbol_col].dropna().unique()), written
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+## the modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+
+
+@pytest.fixture(scope='session')
+def panel():
+    ## small SSE panel with suspensions, staggered listings and missing returns, shuffled out of symbol order
+    data = benchmark.synthetic_panel(30, 400, 'SSE', start='2015-01-01', seed=7)[['symbol', 'date', 'ret']]
+    return data.sample(frac=1, random_state=0).sort_values('date', kind='stable')
@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import pytest
+
+import calutils
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(calutils, 'CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache' / 'calendar'
+
+
+def _write_calendar(path, dates, mtime):
+    path.write_text('\n'.join(dates) + '\n')
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_compile_replaces_older_versions(tmp_path, cache_dir):
+    path = tmp_path / 'custom.csv'
+    _write_calendar(path, ['2020-01-02', '2020-01-03'], 10 ** 18)
+    first = calutils._compile(str(path))
+    _write_calendar(path, ['2020-01-02', '2020-01-03', '2020-01-06'], 2 * 10 ** 18)
+    second = calutils._compile(str(path))
+    assert len(first) == 2 and len(second) == 3
+    assert len(os.listdir(cache_dir)) == 1
+    ## a calendar file of the same name elsewhere keeps its own compiled file
+    (tmp_path / 'other').mkdir()
+    _write_calendar(tmp_path / 'other' / 'custom.csv', ['2021-01-04'], 10 ** 18)
+    calutils._compile(str(tmp_path / 'other' / 'custom.csv'))
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_compile_failure_leaves_no_temporary_file(tmp_path, cache_dir, monkeypatch):
+    path = tmp_path / 'custom.csv'
+    _write_calendar(path, ['2020-01-02', '2020-01-03'], 10 ** 18)
+
+    def _fail(*args, **kwargs):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(calutils.np, 'save', _fail)
+    days = calutils._compile(str(path))
+    np.testing.assert_array_equal(days.view('datetime64[D]'), np.array(['2020-01-02', '2020-01-03'], 'datetime64[D]'))
+    assert os.listdir(cache_dir) == []
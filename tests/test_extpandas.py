@@ -0,0 +1,139 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import extpandas
+import parallelmap
+
+
+def _demean(group):
+    return group['x'] - group['x'].mean()
+
+
+def _shared_mappings(_):
+    with open(f'/proc/{os.getpid()}/maps') as f:
+        return [line for line in f if 'extpandas-' in line]
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/maps'), reason='needs /proc')
+def test_shared_transport_releases_mappings():
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({'k': rng.integers(0, 50, 5000), 'x': rng.normal(size=5000)})
+    result = extpandas.parallel_groupby_apply(data.groupby('k'), _demean, transport='shared', max_workers=2,
+                                              progress_bar=False)
+    expected = data['x'] - data.groupby('k')['x'].transform('mean')
+    np.testing.assert_allclose(result.to_numpy(), expected.to_numpy())
+    ## the idle workers of the reusable executor must not keep the removed shared files mapped
+    assert parallelmap.map_loky_raw(_shared_mappings, range(4), max_workers=2, progress_bar=False) == [[]] * 4
+
+
+@pytest.mark.parametrize('backend', ['serial', 'thread'])
+def test_loky_options_rejected_by_other_backends(backend):
+    data = pd.DataFrame({'k': [0, 0, 1], 'x': [1.0, 2.0, 3.0]})
+    with pytest.raises(TypeError, match='telemetry'):
+        extpandas.parallel_groupby_apply(data.groupby('k'), _demean, backend=backend, progress_bar=False,
+                                         telemetry=parallelmap.Telemetry())
+
+
+def test_auto_backend_with_loky_options_uses_processes():
+    data = pd.DataFrame({'k': [0, 0, 1], 'x': [1.0, 2.0, 3.0]})
+    telemetry = parallelmap.Telemetry()
+    result = extpandas.parallel_groupby_apply(data.groupby('k'), _demean, backend='auto', max_workers=2,
+                                              progress_bar=False, telemetry=telemetry)
+    assert result.tolist() == [-0.5, 0.5, 0.0]
+    assert sorted(task['index'] for task in telemetry.tasks) == [0, 1]
+
+
+def _ols_reference(data, window, min_periods):
+    ## plain lstsq on every window of every group
+    columns = ['beta_const', 'beta_x1', 'beta_x2', 't_const', 't_x1', 't_x2', 'r2', 'resid_vol', 'nobs']
+    expected = pd.DataFrame(np.nan, index=data.index, columns=columns)
+    for _, group in data.groupby('g', sort=False):
+        for end in range(len(group)):
+            rows = group.iloc[max(end - window + 1, 0):end + 1].dropna(subset=['y', 'x1', 'x2'])
+            expected.loc[group.index[end], 'nobs'] = len(rows)
+            if len(rows) < max(min_periods, 4):
+                continue
+            X = np.column_stack([np.ones(len(rows)), rows[['x1', 'x2']].to_numpy()])
+            y = rows['y'].to_numpy()
+            beta = np.linalg.lstsq(X, y, rcond=None)[0]
+            resid = y - X @ beta
+            s2 = resid @ resid / (len(rows) - 3)
+            se = np.sqrt(np.diag(np.linalg.inv(X.T @ X)) * s2)
+            r2 = 1 - resid @ resid / ((y - y.mean()) @ (y - y.mean()))
+            expected.loc[group.index[end], columns[:-1]] = [*beta, *(beta / se), r2, np.sqrt(s2)]
+    return expected
+
+
+def test_rolling_ols_matches_lstsq(monkeypatch):
+    rng = np.random.default_rng(1)
+    n = 400
+    data = pd.DataFrame({'g': rng.integers(0, 3, n), 'x1': rng.normal(size=n), 'x2': rng.normal(size=n)})
+    data['y'] = 0.5 + 2 * data['x1'] - data['x2'] + rng.normal(scale=0.3, size=n)
+    data.loc[rng.choice(n, 20, replace=False), 'y'] = np.nan
+    data.loc[rng.choice(n, 10, replace=False), 'x2'] = np.nan
+    ## small chunks so that windows cross the chunk boundaries
+    monkeypatch.setattr(extpandas, 'ROLLING_OLS_CHUNK', 37)
+    result = extpandas.rolling_ols(data, 'y', ['x1', 'x2'], window=30, min_periods=10, by='g')
+    expected = _ols_reference(data, 30, 10)
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-7, atol=1e-9)
+
+
+@pytest.fixture(scope='module')
+def cross_section():
+    ## 20 dates of 60 stocks, with ties, missing values and one date of a single stock
+    rng = np.random.default_rng(2)
+    n = 1200
+    data = pd.DataFrame({'date': np.repeat(np.arange(20), 60), 'industry': rng.choice(list('abcd'), n),
+                         'size': rng.normal(size=n), 'f': rng.normal(size=n).round(1)})
+    data['f'] += 0.3 * data['size']
+    data.loc[rng.choice(n, 60, replace=False), 'f'] = np.nan
+    data.loc[rng.choice(n, 20, replace=False), 'industry'] = None
+    data = pd.concat([data, pd.DataFrame({'date': [20], 'industry': ['a'], 'size': [0.0], 'f': [1.0]})],
+                     ignore_index=True)
+    return data.sample(frac=1, random_state=3)
+
+
+def test_grouped_zscore_matches_pandas(cross_section):
+    grouped = cross_section.groupby('date')['f']
+    expected = (cross_section['f'] - grouped.transform('mean')) / grouped.transform('std')
+    result = extpandas.grouped_zscore(cross_section, 'f', by='date')['f']
+    np.testing.assert_allclose(result, expected, rtol=1e-10, equal_nan=True)
+
+
+@pytest.mark.parametrize('method', ['average', 'min', 'max', 'first', 'dense'])
+@pytest.mark.parametrize('pct, ascending', [(False, True), (True, False)])
+def test_grouped_rank_matches_pandas(cross_section, method, pct, ascending):
+    expected = cross_section.groupby('date')['f'].rank(method=method, pct=pct, ascending=ascending)
+    result = extpandas.grouped_rank(cross_section, 'f', by='date', method=method, pct=pct, ascending=ascending)
+    np.testing.assert_allclose(result['f'], expected, rtol=1e-12, equal_nan=True)
+
+
+def test_grouped_qcut_matches_pandas(cross_section):
+    def qcut(values):
+        ranks = values.rank(method='min')
+        return pd.qcut(ranks, 5, labels=False, duplicates='drop') if ranks.nunique() > 1 else ranks * 0
+    expected = cross_section.groupby('date')['f'].transform(qcut)
+    result = extpandas.grouped_qcut(cross_section, 'f', by='date', q=5)['f']
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_grouped_winsorize_matches_pandas(cross_section):
+    grouped = cross_section.groupby('date')['f']
+    expected = cross_section['f'].clip(grouped.transform(lambda x: x.quantile(0.05)),
+                                       grouped.transform(lambda x: x.quantile(0.95)))
+    result = extpandas.grouped_winsorize(cross_section, 'f', by='date', lower=0.05, upper=0.95)['f']
+    np.testing.assert_allclose(result, expected, rtol=1e-12, equal_nan=True)
+
+
+def test_grouped_neutralize_matches_lstsq(cross_section):
+    expected = pd.Series(np.nan, index=cross_section.index)
+    valid = cross_section.dropna(subset=['f', 'industry'])
+    for _, group in valid.groupby('date'):
+        X = np.column_stack([pd.get_dummies(group['industry']).to_numpy(dtype=float), group['size']])
+        beta = np.linalg.lstsq(X, group['f'].to_numpy(), rcond=None)[0]
+        expected[group.index] = group['f'].to_numpy() - X @ beta
+    result = extpandas.grouped_neutralize(cross_section, 'f', by='date', industry='industry', exposures='size')['f']
+    np.testing.assert_allclose(result, expected, rtol=1e-8, atol=1e-10, equal_nan=True)
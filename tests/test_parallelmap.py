@@ -0,0 +1,69 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+import parallelmap
+
+pytestmark = pytest.mark.filterwarnings('ignore::parallelmap.TaskTimeoutWarning')
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def _stubborn(seconds):
+    ## swallows the interruption of the watchdog, so its worker has to be killed
+    end = time.time() + seconds
+    while time.time() < end:
+        try:
+            time.sleep(0.01)
+        except BaseException:
+            pass
+    return seconds
+
+
+def _counted(task):
+    directory, idx, seconds = task
+    with open(os.path.join(directory, str(idx)), 'a') as f:
+        f.write('x')
+    return _stubborn(seconds)
+
+
+def test_map_loky_timeout_interrupts_task():
+    results, timeouts = parallelmap.map_loky(_sleep, [0.01, 5, 0.01], max_workers=2, progress_bar=False,
+                                             timeout=0.5, timeout_replacer=-1, return_timeouts=True)
+    assert results == [0.01, -1, 0.01]
+    assert timeouts == [1]
+
+
+def test_map_loky_timeout_kills_stubborn_task():
+    results, timeouts = parallelmap.map_loky(_stubborn, [0.01, 10, 0.01, 0.01], max_workers=2, progress_bar=False,
+                                             timeout=0.5, return_timeouts=True)
+    assert results == [0.01, None, 0.01, 0.01]
+    assert timeouts == [1]
+    ## the executor is usable again by the next caller
+    assert parallelmap.map_loky_raw(_sleep, [0, 0], max_workers=2, progress_bar=False) == [0, 0]
+
+
+def test_killed_chunk_keeps_finished_results(tmp_path):
+    ## the task before the stubborn one in its chunk has finished when the worker is killed, it is not run again
+    seconds = [0.01] * 8
+    seconds[1] = 10
+    tasks = [(str(tmp_path), idx, value) for idx, value in enumerate(seconds)]
+    telemetry = parallelmap.Telemetry()
+    results, timeouts = parallelmap.map_loky(_counted, tasks, max_workers=2, progress_bar=False, timeout=0.5,
+                                             chunksize=4, return_timeouts=True, telemetry=telemetry)
+    assert timeouts == [1]
+    assert results == [None if idx == 1 else value for idx, value in enumerate(seconds)]
+    assert {idx: len((tmp_path / str(idx)).read_text()) for idx in range(8)} == dict.fromkeys(range(8), 1)
+    assert sorted(task['index'] for task in telemetry.tasks) == list(range(8))
+    assert [task['index'] for task in telemetry.tasks if task['timed_out']] == [1]
+
+
+def test_amap_loky_timeout():
+    results = asyncio.run(parallelmap.amap_loky(_stubborn, [0.01, 10, 0.01], max_workers=2, progress_bar=False,
+                                                timeout=0.5, timeout_replacer=-1))
+    assert results == [0.01, -1, 0.01]
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import calutils
+import pitutils
+
+
+def test_pit_table_warns_beyond_calendar():
+    last = calutils.get_calendar('SSE').dates[-1]
+    reports = pd.DataFrame({'symbol': ['A', 'A', 'B'],
+                            'ann_date': pd.to_datetime([last, last + 5, pd.NaT]),
+                            'period': ['2022Q4', '2023Q1', '2023Q1'],
+                            'eps': [1.0, 2.0, 3.0]})
+    with pytest.warns(UserWarning, match='1 filings announced up to'):
+        table = pitutils.pit_table(reports)
+    assert table['eps'].tolist() == [1.0]
+
+
+@pytest.fixture
+def reports():
+    return pd.DataFrame({'symbol': ['A', 'A', 'A', 'A', 'B', 'B'],
+                         'ann_date': pd.to_datetime(['2020-03-28', '2020-04-20', '2020-04-25', '2020-04-27',
+                                                     '2020-04-22', None]),
+                         'period': ['2019Q4', '2020Q1', '2019Q4', '2020Q1', '2020Q1', '2020Q2'],
+                         'eps': [1.0, 2.0, 1.5, 2.5, 3.0, 4.0]})
+
+
+def test_pit_table_restatements(reports):
+    table = pitutils.pit_table(reports)
+    ## the restatement of 2019Q4 after 2020Q1 is dropped, the one of 2020Q1 is kept, the filing without date too
+    assert table['eps'].tolist() == [1.0, 2.0, 2.5, 3.0]
+    assert table['effective_date'].dt.strftime('%Y-%m-%d').tolist() == ['2020-03-30', '2020-04-20',
+                                                                        '2020-04-27', '2020-04-22']
+    lagged = pitutils.pit_table(reports, lag=1)
+    assert lagged['effective_date'].dt.strftime('%Y-%m-%d').tolist() == ['2020-03-30', '2020-04-21',
+                                                                         '2020-04-28', '2020-04-23']
+
+
+def test_asof_join_edge_cases(reports):
+    panel = pd.DataFrame({'symbol': ['A', 'A', 'A', 'A', 'A', 'B', 'B', 'C', 'A'],
+                          'date': pd.to_datetime(['2020-03-27', '2020-03-30', '2020-04-20', '2020-04-27',
+                                                  '2020-04-28', '2020-04-22', '2020-04-24', '2020-04-24', None])},
+                         index=list('abcdefghi'))
+    result = pitutils.asof_join(panel, reports, fields=['eps'])
+    assert result.index.equals(panel.index)
+    ## unknown symbols and missing dates get NaN
+    np.testing.assert_array_equal(result['eps'], [np.nan, 1.0, 2.0, 2.5, 2.5, 3.0, 3.0, np.nan, np.nan])
+    assert result.loc['d', 'period'] == '2020Q1'
+    np.testing.assert_array_equal(pitutils.asof_join(panel, reports, fields=['eps'], lag=1)['eps'],
+                                  [np.nan, 1.0, 1.0, 2.0, 2.5, np.nan, 3.0, np.nan, np.nan])
+    ## B is effective on 2020-04-22, two trading days and two calendar days before 2020-04-24
+    np.testing.assert_array_equal(pitutils.asof_join(panel, reports, fields=['eps'], max_staleness=1)['eps'],
+                                  [np.nan, 1.0, 2.0, 2.5, 2.5, 3.0, np.nan, np.nan, np.nan])
+    np.testing.assert_array_equal(pitutils.asof_join(panel, reports, fields=['eps'], max_staleness=2)['eps'],
+                                  [np.nan, 1.0, 2.0, 2.5, 2.5, 3.0, 3.0, np.nan, np.nan])
+    np.testing.assert_array_equal(pitutils.asof_join(panel, reports, fields=['eps'], max_staleness='1D')['eps'],
+                                  [np.nan, 1.0, 2.0, 2.5, 2.5, 3.0, np.nan, np.nan, np.nan])
+
+
+def test_asof_join_matches_merge_asof(panel):
+    rng = np.random.default_rng(4)
+    symbols = panel['symbol'].unique()
+    reports = pd.DataFrame({'symbol': rng.choice(symbols, 300),
+                            'ann_date': pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 560, 300), 'D'),
+                            'period': rng.choice(['2014Q4', '2015Q1', '2015Q2', '2015Q3', '2015Q4'], 300),
+                            'value': rng.normal(size=300)})
+    result = pitutils.asof_join(panel, reports, fields=['value'], lag=1)
+    table = pitutils.pit_table(reports, lag=1).sort_values('effective_date', kind='stable')
+    expected = pd.merge_asof(panel.reset_index().sort_values('date'), table, left_on='date',
+                             right_on='effective_date', by='symbol').set_index('index').reindex(panel.index)
+    np.testing.assert_array_equal(result['value'], expected['value'])
+    assert result['period'].fillna('').tolist() == expected['period'].fillna('').tolist()
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from retutils import RetCalc
+
+
+@pytest.fixture(scope='module')
+def calculator(panel):
+    return RetCalc(panel.copy(), calendar_path='SSE')
+
+
+@pytest.mark.parametrize('M, N', [(1, 1), (2, 5), (1, 20)])
+def test_ret_pM_pN_engines_match(calculator, M, N):
+    vectorized = calculator.ret_pM_pN(M, N)
+    legacy = calculator.ret_pM_pN(M, N, engine='loky', max_workers=2, progress_bar=False)
+    ## the legacy engine returns the rows grouped by symbol, the vectorized engine in the order of the data
+    assert vectorized.index.equals(calculator.index)
+    np.testing.assert_allclose(vectorized, legacy.reindex(vectorized.index), rtol=1e-9, atol=1e-12, equal_nan=True)
+
+
+def test_numpy_engine_warns_on_pool_kwargs(calculator):
+    with pytest.warns(UserWarning, match="max_workers ignored by engine='numpy'"):
+        calculator.ret_pM_pN(1, 5, max_workers=2)
+    with pytest.warns(UserWarning, match="progress_bar ignored by engine='numpy'"):
+        calculator.ret_m_K(5, progress_bar=False)
+
+
+
+def test_loky_engine_keeps_vectorized_layout(panel):
+    calculator = RetCalc(panel.copy(), calendar_path='SSE')
+    expected = calculator.ret_m_K(1)
+    calculator.ret_pM_pN(1, 5, engine='loky', max_workers=2, progress_bar=False)
+    pd.testing.assert_frame_equal(calculator.ret_m_K(1), expected)
+
+
+def _sorted_months(frame):
+    return frame.sort_values(['symbol', 'start'], ignore_index=True)
+
+
+@pytest.mark.parametrize('key_day', [1, 15, 28])
+def test_ret_m_K_engines_match(calculator, key_day):
+    vectorized = _sorted_months(calculator.ret_m_K(key_day))
+    legacy = _sorted_months(calculator.ret_m_K(key_day, engine='loky', max_workers=2, progress_bar=False))
+    pd.testing.assert_frame_equal(vectorized, legacy, check_exact=False, rtol=1e-9, atol=1e-12)
+
+
+def test_append_update_matches_full_recompute(panel):
+    pairs = [(1, 1), (2, 5), (1, 20)]
+    cutoff = panel['date'].quantile(0.8)
+    ## a symbol listed only in the appended rows
+    late = panel['symbol'] == panel['symbol'].iloc[-1]
+    old = panel[(panel['date'] < cutoff) & ~late]
+    new = panel[(panel['date'] >= cutoff) | late]
+    calculator = RetCalc(old.copy(), calendar_path='SSE')
+    prev = calculator.ret_pM_pN_batch(pairs)
+    prev_m = calculator.ret_m_K(15)
+    calculator.append(new.copy())
+    full = RetCalc(pd.concat([old, new]), calendar_path='SSE')
+    updated = calculator.ret_pM_pN_update(prev)
+    expected = full.ret_pM_pN_batch(pairs)
+    assert updated.index.equals(expected.index)
+    np.testing.assert_allclose(updated, expected[updated.columns], rtol=1e-9, atol=1e-12, equal_nan=True)
+    pd.testing.assert_frame_equal(_sorted_months(calculator.ret_m_K_update(15, prev_m)),
+                                  _sorted_months(full.ret_m_K(15)), check_exact=False, rtol=1e-9, atol=1e-12)
+
+
+def test_append_rejects_earlier_rows(panel):
+    calculator = RetCalc(panel.copy(), calendar_path='SSE')
+    with pytest.raises(ValueError, match='must be later'):
+        calculator.append(panel.iloc[:5].copy())
+
+
+def test_compact_matches_dataframe_mode(panel, calculator):
+    pairs = [(1, 1), (2, 5), (1, 20)]
+    compact = RetCalc(panel.copy(), calendar_path='SSE', compact=True)
+    assert compact.data is None
+    result = compact.ret_pM_pN_batch(pairs)
+    expected = calculator.ret_pM_pN_batch(pairs)
+    assert result.index.equals(expected.index)
+    np.testing.assert_allclose(result, expected, rtol=1e-9, atol=1e-12, equal_nan=True)
+    ## the symbols of the monthly returns are categorical in compact mode
+    for key_day, monthly in compact.ret_m_K_batch([1, 15]).items():
+        expected_m = calculator.ret_m_K(key_day)
+        monthly = monthly.astype({'symbol': expected_m['symbol'].dtype})
+        pd.testing.assert_frame_equal(_sorted_months(monthly), _sorted_months(expected_m),
+                                      check_exact=False, rtol=1e-9, atol=1e-12)
+    ## float32 returns, the calculation is still done in float64
+    single = RetCalc(panel.copy(), calendar_path='SSE', compact=True, ret_dtype=np.float32)
+    np.testing.assert_allclose(single.ret_pM_pN_batch(pairs), expected, rtol=1e-5, atol=1e-6, equal_nan=True)
+    with pytest.raises(ValueError, match='compact mode'):
+        compact.ret_pM_pN(1, 5, engine='loky')
@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from retutils import RetCalc
+
+PAIRS = [(1, 5), (2, 20)]
+KEY_DAYS = [1, 15]
+
+
+def _read_parts(paths):
+    data = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+    for col in ['date', 'start', 'end', 'end_expected']:
+        if col in data.columns:
+            data[col] = pd.to_datetime(data[col])
+    return data
+
+
+def _expected(panel):
+    calculator = RetCalc(panel.copy(), calendar_path='SSE')
+    forward = pd.concat([panel, calculator.ret_pM_pN_batch(PAIRS)], axis=1)
+    return forward.sort_values(['symbol', 'date'], ignore_index=True), calculator.ret_m_K_batch(KEY_DAYS)
+
+
+def _write_hive(panel, source, n_files):
+    ## several files per symbol=XXX directory, named so that their order is not the date order
+    for symbol, group in panel.groupby('symbol'):
+        directory = os.path.join(source, f'symbol={symbol}')
+        os.makedirs(directory)
+        group = group.drop(columns='symbol').sort_values('date')
+        for k, rows in enumerate(np.array_split(np.arange(len(group)), n_files)):
+            group.iloc[rows].to_csv(os.path.join(directory, f'part-{n_files - k}.csv'), index=False)
+
+
+def _check(written, panel):
+    forward, monthly = _expected(panel)
+    result = _read_parts(written['ret_pM_pN']).sort_values(['symbol', 'date'], ignore_index=True)
+    for M, N in PAIRS:
+        np.testing.assert_allclose(result[f'ret_p{M}_p{N}'], forward[f'ret_p{M}_p{N}'], rtol=1e-9, atol=1e-12, equal_nan=True)
+    for key_day in KEY_DAYS:
+        result = _read_parts(written[f'ret_m_{key_day}']).sort_values(['symbol', 'start'], ignore_index=True)
+        expected = monthly[key_day].sort_values(['symbol', 'start'], ignore_index=True)
+        np.testing.assert_array_equal(result['symbol'], expected['symbol'])
+        np.testing.assert_array_equal(result['end'], expected['end'])
+        np.testing.assert_allclose(result[f'ret_m_{key_day}'], expected[f'ret_m_{key_day}'], rtol=1e-9, atol=1e-12)
+
+
+@pytest.mark.parametrize('batch_bytes', [1, 1 << 30])
+def test_stream_matches_full_recompute(panel, tmp_path, batch_bytes):
+    source = tmp_path / 'source'
+    for symbol, group in panel.groupby('symbol'):
+        os.makedirs(source, exist_ok=True)
+        group.to_csv(source / f'{symbol}.csv', index=False)
+    written = RetCalc.stream(str(source), str(tmp_path / 'out'), pairs=PAIRS, key_days=KEY_DAYS, calendar_path='SSE',
+                             batch_bytes=batch_bytes, max_workers=2, progress_bar=False)
+    _check(written, panel)
+
+
+def test_stream_hive_files_out_of_date_order(panel, tmp_path):
+    source = tmp_path / 'source'
+    _write_hive(panel, str(source), n_files=3)
+    written = RetCalc.stream(str(source), str(tmp_path / 'out'), pairs=PAIRS, key_days=KEY_DAYS, calendar_path='SSE',
+                             batch_bytes=1, max_workers=2, progress_bar=False)
+    _check(written, panel)
+
+
+def _slow_batch(*args, **kwargs):
+    import time
+    time.sleep(30)
+
+
+@pytest.mark.filterwarnings('ignore::parallelmap.TaskTimeoutWarning')
+def test_stream_timeout_raises(panel, tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    _write_hive(panel, str(source), n_files=1)
+    ## RetCalc.stream binds the worker from the module attribute when it is called
+    monkeypatch.setattr('retutils._stream_batch', _slow_batch)
+    with pytest.raises(TimeoutError, match='batch 0'):
+        RetCalc.stream(str(source), str(tmp_path / 'out'), pairs=PAIRS, calendar_path='SSE',
+                       max_workers=1, progress_bar=False, timeout=0.5)
+    assert os.listdir(tmp_path / 'out') == []
+
+
+def test_stream_split_symbol_leaves_no_output(panel, tmp_path):
+    ## one symbol spread over two shards outside of hive directories, detected only after the batches have run
+    source = tmp_path / 'source'
+    os.makedirs(source)
+    for symbol, group in panel.groupby('symbol'):
+        group.to_csv(source / f'{symbol}.csv', index=False)
+    split = panel[panel['symbol'] == panel['symbol'].iloc[0]]
+    split.iloc[:10].to_csv(source / 'zzz.csv', index=False)
+    out = tmp_path / 'out'
+    with pytest.raises(ValueError, match='not partitioned by symbol'):
+        RetCalc.stream(str(source), str(out), pairs=PAIRS, key_days=KEY_DAYS, calendar_path='SSE',
+                       batch_bytes=1, max_workers=2, progress_bar=False)
+    assert os.listdir(out) == []